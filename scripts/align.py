@@ -24,15 +24,21 @@
 
 import json
 import pickle
-import subprocess
 import sys
-from collections import defaultdict, deque
-from joblib import Parallel, delayed
+from collections import defaultdict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from subprocess import DEVNULL, Popen
+from threading import Thread
 
 import numpy as np
 
 from arcas_utilities import *
+from container import is_container, read_container, read_header, write_container
+from fastq import collapse_reads, fastq_stats, open_fastq, sample_reads
 from reference import get_exon_combinations
+from tables import get_gene_codes, load_reference
 
 # -------------------------------------------------------------------------------
 
@@ -45,128 +51,437 @@ __date__ = "2022-01-27"
 
 rootDir = os.path.dirname(os.path.realpath(__file__)) + "/../"
 
+# Binary alignment files start with this magic, followed by a JSON header
+# carrying the format version
+alignment_magic = b"ARCASALN"
+alignment_version = 1
+
 
 # -----------------------------------------------------------------------------
 # Process and align FASTQ input
 # -----------------------------------------------------------------------------
-def get_read_lengths(fqs, chunk_size=500 * 1024 * 1024):
-    """Get read lengths from FASTQ files efficiently by processing data in chunks using deque."""
-    awk_cmd = "awk '{if(NR%4==2) print length($1)}'"
-    read_lengths = deque()
-
-    for fq in fqs:
-        if fq.endswith('.gz'):
-            cat_cmd = 'zcat'
-        else:
-            cat_cmd = 'cat'
-
-        # Constructing the command
-        cmd = f"{cat_cmd} {fq} | {awk_cmd}"
-
-        # Execute the command and process output in chunks
-        with subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, text=True, bufsize=chunk_size) as proc:
-            while True:
-                lines = proc.stdout.readlines(chunk_size)
-                if not lines:
-                    break
-                read_lengths.extend(int(line.strip()) for line in lines if line.strip())
-
-    return np.array(read_lengths)
-
-def get_read_length_for_file(fq, chunk_size=500*1024*1024):  # Using 500 MB chunk size
-    """Process a single FASTQ file to extract read lengths using shell commands."""
-    awk_cmd = "awk '{if(NR%4==2) print length($1)}'"
-    cat_cmd = 'zcat' if fq.endswith('.gz') else 'cat'
-    cmd = f"{cat_cmd} {fq} | {awk_cmd}"
-    print(f"{cmd=}")
-    read_lengths = deque()
-
-    # Execute the command and process output in chunks
-    with subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, text=True, bufsize=chunk_size) as proc:
-        while True:
-            lines = proc.stdout.readlines(chunk_size)
-            if not lines:
-                break
-            read_lengths.extend(int(line.strip()) for line in lines if line.strip())
-    print(f"{len(read_lengths)=}")
-    return np.array(read_lengths)
-
-
-def parallel_get_read_lengths(fqs):
-    """Use parallel processing to get read lengths from multiple FASTQ files."""
-    num_jobs = len(fqs)
-    print(f"{num_jobs=}")
-    results = Parallel(n_jobs=num_jobs)(delayed(get_read_length_for_file)(fq) for fq in fqs)
-    read_lengths = np.concatenate(results)
-    return read_lengths
-
-
-def pseudoalign(fqs, sample, paired, reference, outdir, temp, threads, avg, std):
-    """Calls Kallisto to pseudoalign reads."""
-
-    log.info("[alignment] Analyzing read length")
-
-    read_lengths = get_read_lengths(fqs)
-    #read_lengths = parallel_get_read_lengths(fqs)
-
-    if len(read_lengths) == 0:
-        sys.exit("[genotype] Error: FASTQ files are empty; check arcasHLA extract for issues.")
-
+def get_processed_reads(temp, stderr):
+    """Returns the number of reads or pairs processed by Kallisto, from its
+       run metadata or else its log, or None if neither reports it.
+    """
+    run_info = "".join([temp, "run_info.json"])
+    if os.path.isfile(run_info):
+        with open(run_info, "r") as file:
+            n_processed = json.load(file).get("n_processed")
+        if n_processed is not None:
+            return int(n_processed)
+
+    processed = re.findall("(?<=processed ).+(?= reads,)", stderr)
+    if processed:
+        return int(re.sub(",", "", processed[0]))
+
+    return None
+
+
+def kallisto_command(fqs, paired, reference, temp, threads, avg, std):
+    """Returns the Kallisto command pseudoaligning reads to an index."""
     command = ["kallisto pseudo -i", reference, "-t", threads, "-o", temp]
 
     if not paired:
         command.extend(["--single -l", str(avg), "-s", str(std)])
 
     command.extend(fqs)
-    run_command(command, "[alignment] Pseudoaligning with Kallisto: ")
-
-    num = len(read_lengths)
+    return " ".join(command)
+
+
+def stream_fastq(fq, fifos, errors, chunk_size=1024 * 1024, max_chunks=64):
+    """Decompresses a FASTQ once and writes it to several named pipes, each
+       from its own thread. A pipe may fall up to max_chunks behind the
+       others, so that runs reading paired files at different rates do not
+       stall each other. Read errors are added to errors.
+    """
+    queues = [Queue(max_chunks) for _ in fifos]
+
+    # Writes chunks to a pipe, discarding the rest if its reader exits
+    def write_fifo(fifo, queue):
+        chunk = b""
+        try:
+            with open(fifo, "wb") as file:
+                while (chunk := queue.get()) is not None:
+                    file.write(chunk)
+        except BrokenPipeError:
+            while chunk is not None:
+                chunk = queue.get()
+
+    # Reads the FASTQ once, handing each chunk to every writer
+    def read_fastq():
+        try:
+            with open_fastq(fq) as file:
+                while chunk := file.read(chunk_size):
+                    for queue in queues:
+                        queue.put(chunk)
+        except (OSError, EOFError) as err:
+            errors.append(f"{fq}: {err}")
+        finally:
+            for queue in queues:
+                queue.put(None)
+
+    threads = [Thread(target=write_fifo, args=(fifo, queue), daemon=True)
+               for fifo, queue in zip(fifos, queues)]
+    threads.append(Thread(target=read_fastq, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    return threads
+
+
+def share_threads(sizes, threads):
+    """Divides threads between runs in proportion to their input sizes,
+       giving each run at least one thread.
+    """
+    if len(sizes) >= threads:
+        return [1] * len(sizes)
+
+    total = sum(sizes) or 1
+    shares = [(threads - len(sizes)) * size / total for size in sizes]
+    run_threads = [1 + int(share) for share in shares]
+
+    # Hands out the threads left over by rounding down, largest part first
+    leftover = threads - sum(run_threads)
+    order = sorted(range(len(sizes)), key=lambda i: shares[i] - int(shares[i]),
+                   reverse=True)
+    for i in order[:leftover]:
+        run_threads[i] += 1
+
+    return run_threads
+
+
+def pseudoalign_shared(fqs, paired, references, temps, threads, avg, std):
+    """Runs Kallisto against several indices at once, each writing to its
+       own temporary folder. Every FASTQ is read a single time and streamed
+       to all runs through named pipes, which split the threads between
+       them. Returns the log of each run.
+    """
+    fifos = [["".join([temp, "reads_", str(i), ".fq"]) for temp in temps]
+             for i in range(len(fqs))]
+    for fq_fifos in fifos:
+        for fifo in fq_fifos:
+            os.mkfifo(fifo)
+
+    errors = []
+    streams = [stream_fastq(fq, fq_fifos, errors)
+               for fq, fq_fifos in zip(fqs, fifos)]
+
+    processes = []
+    logs = []
+    run_threads = share_threads([1] * len(references), int(threads))
+    for i, (reference, temp) in enumerate(zip(references, temps)):
+        command = kallisto_command([fq_fifos[i] for fq_fifos in fifos],
+                                   paired, reference, temp,
+                                   str(run_threads[i]), avg, std)
+        log.info(f"[alignment] Pseudoaligning with Kallisto: \n\n\t{command}\n")
+
+        logs.append("".join([temp, "kallisto.log"]))
+        with open(logs[-1], "wb") as stderr:
+            processes.append(Popen(command.split(), stdout=DEVNULL,
+                                   stderr=stderr))
+
+    # Waits for runs as they finish. A failed run stops the others, which
+    # would otherwise wait on pipes that are no longer read
+    finished = Queue()
+    for process in processes:
+        Thread(target=lambda process: finished.put(process.wait()),
+               args=(process,), daemon=True).start()
+
+    failed = False
+    for _ in processes:
+        if finished.get() != 0:
+            failed = True
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+            break
+
+    outputs = []
+    for file in logs:
+        with open(file, "r") as handle:
+            outputs.append(handle.read())
+        stderr = "\t" + re.sub("\n", "\n\t", outputs[-1])
+        if len(stderr) > 1:
+            log.info(stderr)
+
+    if failed:
+        sys.exit("[alignment] Error: Kallisto pseudoalignment failed.")
+
+    for threads in streams:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        sys.exit("[alignment] Error: could not read " + ", ".join(errors))
+
+    return outputs
+
+
+def run_pseudoalignment(fqs, paired, reference, temp, threads, avg, std,
+                        partial_reference=None, partial_temp=None):
+    """Runs Kallisto on the reads, together with the partial index if given,
+       returning the log of the run against reference.
+    """
+    if partial_reference is None:
+        command = kallisto_command(fqs, paired, reference, temp, threads,
+                                   avg, std)
+        output = run_command(command,
+                             "[alignment] Pseudoaligning with Kallisto: ")
+        return output.stderr.decode()
+
+    stderr, _ = pseudoalign_shared(fqs, paired,
+                                   [reference, partial_reference],
+                                   [temp, partial_temp], threads, avg, std)
+    return stderr
+
+
+def merge_pseudoalignments(temps, weights, outdir):
+    """Sums the class counts of several Kallisto runs, scaled by weight,
+       writing them in Kallisto's format to outdir. Runs number the classes
+       they add to the index differently, so classes are matched by their
+       reference indices and kept in order of their lowest number.
+    """
+    classes = dict()
+    for temp, weight in zip(temps, weights):
+        offsets, indices, counts = read_pseudoalignments(
+            "".join([temp, "pseudoalignments.tsv"]),
+            "".join([temp, "pseudoalignments.ec"]))
+        offsets = offsets.tolist()
+        indices = indices.tolist()
+
+        for ec, count in enumerate(counts.tolist()):
+            key = tuple(indices[offsets[ec]:offsets[ec + 1]])
+            first, total = classes.get(key, (ec, 0))
+            classes[key] = min(first, ec), total + count * weight
+
+    classes = sorted(classes.items(), key=lambda item: item[1][0])
+    with open("".join([outdir, "pseudoalignments.ec"]), "w") as eq_file, \
+            open("".join([outdir, "pseudoalignments.tsv"]), "w") as count_file:
+        for ec, (key, (_, count)) in enumerate(classes):
+            eq_file.write("{}\t{}\n".format(ec, ",".join(map(str, key))))
+            count_file.write("{}\t{:.0f}\n".format(ec, count))
+
+
+def pseudoalign_collapsed(fqs, paired, reference, temp, threads, avg, std,
+                          partial_reference=None, partial_temp=None):
+    """Pseudoaligns identical reads or pairs once. Unique reads are grouped
+       by the bits of their multiplicity, the groups are pseudoaligned
+       concurrently, sharing threads by size, and the class counts are
+       merged, scaled by 2 ** bit, into Kallisto output in temp. Returns the
+       number of FASTQ records.
+    """
+    log.info("[alignment] Collapsing identical reads")
+    outputs, records, unique = collapse_reads(fqs, "".join([temp,
+                                                            "collapsed"]))
+    log.info("[alignment] %s records collapsed to %s unique %s",
+             records, unique, "pairs" if paired else "reads")
+
+    groups = sorted(outputs.items())
+    temps, partial_temps, weights = [], [], []
+    for bit, _ in groups:
+        temps.append(check_path("".join([temp, "collapsed_", str(bit)])))
+        partial_temps.append(None)
+        if partial_reference is not None:
+            partial_temps[-1] = check_path("".join([partial_temp,
+                                                    "collapsed_", str(bit)]))
+        weights.append(2 ** bit)
+
+    # Every run loads the index, so the groups run side by side rather than
+    # one after another, largest first
+    sizes = [sum(os.path.getsize(fq) for fq in bit_fqs)
+             for _, bit_fqs in groups]
+    run_threads = share_threads(sizes, int(threads))
+    order = sorted(range(len(groups)), key=lambda i: sizes[i], reverse=True)
+
+    workers = max(1, min(int(threads), len(groups)))
+    with ThreadPoolExecutor(workers) as executor:
+        runs = [executor.submit(run_pseudoalignment, groups[i][1], paired,
+                                reference, temps[i], str(run_threads[i]),
+                                avg, std, partial_reference,
+                                partial_temps[i])
+                for i in order]
+        for run in runs:
+            run.result()
+
+    merge_pseudoalignments(temps, weights, temp)
+    if partial_reference is not None:
+        merge_pseudoalignments(partial_temps, weights, partial_temp)
+
+    return records
+
+
+def pseudoalign(fqs, sample, paired, reference, outdir, temp, threads, avg,
+                std, count_reads=False, partial_reference=None,
+                partial_temp=None, collapse=False):
+    """Calls Kallisto to pseudoalign reads, returning the number of FASTQ
+       records processed. Counts the records separately if count_reads is
+       set, checking them against Kallisto's total. If a partial index is
+       given, the reads are pseudoaligned against it in the same pass, with
+       its output written to partial_temp. Identical reads are pseudoaligned
+       once if collapse is set.
+    """
+
+    if count_reads:
+        log.info("[alignment] Counting reads")
+        num = fastq_stats(fqs).records
+
+        if num == 0:
+            sys.exit("[genotype] Error: FASTQ files are empty; check arcasHLA extract for issues.")
+
+    if collapse:
+        processed = pseudoalign_collapsed(fqs, paired, reference, temp,
+                                          threads, avg, std,
+                                          partial_reference, partial_temp)
+    else:
+        stderr = run_pseudoalignment(fqs, paired, reference, temp, threads,
+                                     avg, std, partial_reference,
+                                     partial_temp)
+
+        # Kallisto counts pairs, scales to records as counted in the FASTQs
+        processed = get_processed_reads(temp, stderr)
+        if processed is not None:
+            processed *= 2 if paired else 1
+
+    if count_reads:
+        if processed is not None and processed != num:
+            log.info("[alignment] Warning: Kallisto processed %s reads, " +
+                     "FASTQs contain %s", processed, num)
+        return num
+
+    if processed is None:
+        log.info("[alignment] Kallisto did not report processed reads, " +
+                 "counting reads")
+        processed = fastq_stats(fqs).records
+
+    if processed == 0:
+        sys.exit("[genotype] Error: FASTQ files are empty; check arcasHLA extract for issues.")
 
-    return num
+    return processed
 
 
 # -----------------------------------------------------------------------------
 # Process transcript assembly output
 # -----------------------------------------------------------------------------
 
-def process_counts(count_file, eq_file, gene_list, allele_idx, allele_lengths):
-    """Processes pseudoalignment output, returning compatibility classes."""
-    log.info("[alignment] Processing pseudoalignment")
+# Maps the tabs and newlines of Kallisto output to commas for parsing
+separator_table = bytes.maketrans(b"\t\n", b",,")
+
+
+def read_numbers(data, dtype=np.int64):
+    """Parses a bytes buffer of numbers, each followed by a tab, comma or
+       newline. Returns the numbers and the byte terminating each.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    terminators = buffer[(buffer == ord(",")) | (buffer == ord("\t"))
+                         | (buffer == ord("\n"))]
+    values = np.fromstring(data.translate(separator_table), dtype=dtype,
+                           sep=",")
+
+    return values, terminators
+
+
+def read_lines(file, chunk_size):
+    """Reads a file in chunks of whole lines."""
+    remainder = b""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        chunk = remainder + chunk
+        end = chunk.rfind(b"\n") + 1
+        remainder = chunk[end:]
+        if end:
+            yield chunk[:end]
+
+    if remainder.strip():
+        yield remainder + b"\n"
+
+
+def read_pseudoalignments(count_file, eq_file, chunk_size=64 * 1024 * 1024):
+    """Reads Kallisto compatibility classes and counts into flat arrays:
+       offsets of each class into its concatenated reference indices, the
+       indices and the count of each class.
+    """
     # Process count information
-    counts = dict()
-    with open(count_file, "r", encoding="UTF-8") as file:
-        for line in file.read().splitlines():
-            eq, count = line.split("\t")
-            counts[eq] = float(count)
+    count_ecs = []
+    count_values = []
+    with open(count_file, "rb") as file:
+        for chunk in read_lines(file, chunk_size):
+            columns, _ = read_numbers(chunk, float)
+            columns = columns.reshape(-1, 2)
+            count_ecs.append(columns[:, 0].astype(np.int64))
+            count_values.append(columns[:, 1])
+    count_ecs = np.concatenate(count_ecs or [np.zeros(0, dtype=np.int64)])
+    count_values = np.concatenate(count_values or [np.zeros(0)])
 
     # Process compatibility classes
-    eqs = dict()
-    with open(eq_file, "r", encoding="UTF-8") as file:
-        for line in file.read().splitlines():
-            eq, indices = line.split("\t")
-            eqs[eq] = indices.split(",")
+    ecs = []
+    indices = []
+    sizes = []
+    with open(eq_file, "rb") as file:
+        for chunk in read_lines(file, chunk_size):
+            values, terminators = read_numbers(chunk)
+            is_ec = terminators == ord("\t")
+            ecs.append(values[is_ec])
+            indices.append(values[~is_ec])
+            sizes.append(np.bincount(np.cumsum(is_ec)[~is_ec] - 1,
+                                     minlength=is_ec.sum()))
+    ecs = np.concatenate(ecs or [np.zeros(0, dtype=np.int64)])
+    indices = np.concatenate(indices or [np.zeros(0, dtype=np.int64)])
+    offsets = np.concatenate([[0], np.cumsum(np.concatenate(sizes or [[]]))])
+
+    counts = np.zeros(max(ecs.max(initial=-1), count_ecs.max(initial=-1)) + 1)
+    counts[count_ecs] = count_values
+
+    return offsets.astype(np.int64), indices, counts[ecs]
+
+
+def classify_classes(offsets, indices, allele_idx, gene_codes=None):
+    """Classifies compatibility classes by gene, returning the genes and,
+       for each class, the position of its gene or -2 if it spans several
+       genes, with a mask of classes containing no non-HLA indices. Gene
+       codes are computed from allele_idx unless given.
+    """
+    if gene_codes is None:
+        gene_codes = get_gene_codes(allele_idx)
+    genes, codes = gene_codes
+    sizes = np.diff(offsets)
+    starts = offsets[:-1][sizes > 0]
+
+    class_codes = np.full(len(sizes), -2, dtype=np.int64)
+    hla = np.zeros(len(sizes), dtype=bool)
+    if len(indices):
+        index_codes = codes[indices]
+        lowest = np.minimum.reduceat(index_codes, starts)
+        highest = np.maximum.reduceat(index_codes, starts)
+        non_hla = np.add.reduceat(index_codes == -1, starts)
+
+        hla[sizes > 0] = non_hla == 0
+        class_codes[sizes > 0] = np.where(lowest == highest, lowest, -2)
+
+    return genes, class_codes, hla
+
+
+def process_counts(count_file, eq_file, gene_list, allele_idx, allele_lengths,
+                   gene_codes=None):
+    """Processes pseudoalignment output, returning compatibility classes."""
+    log.info("[alignment] Processing pseudoalignment")
+    offsets, indices, counts = read_pseudoalignments(count_file, eq_file)
+    genes, class_codes, hla = classify_classes(offsets, indices, allele_idx,
+                                               gene_codes)
+
+    # Classes from a single gene with reads are kept, other classes only
+    # count towards multimapping reads
+    unique = hla & (class_codes >= 0) & (counts > 0)
+    count_unique = counts[unique].sum()
+    count_multi = counts[hla & ~unique].sum()
 
     # Set up compatibility class index
     eq_idx = defaultdict(list)
-
-    count_unique = 0
-    count_multi = 0
-
-    for eq, indices in eqs.items():
-        if [idx for idx in indices if not allele_idx[idx]]:
-            continue
-
-        genes = list({get_gene(allele) for idx in indices
-                      for allele in allele_idx[idx]})
-        count = counts[eq]
-
-        if len(genes) == 1 and counts[eq] > 0:
-            gene = genes[0]
-            eq_idx[gene].append((indices, count))
-
-            count_unique += count
-        else:
-            count_multi += count
+    for i in np.flatnonzero(unique):
+        eq_idx[genes[class_codes[i]]].append(
+            (indices[offsets[i]:offsets[i + 1]].tolist(), float(counts[i])))
 
     # Alleles mapping to their respective compatibility classes
     allele_eq = defaultdict(set)
@@ -175,52 +490,36 @@ def process_counts(count_file, eq_file, gene_list, allele_idx, allele_lengths):
             for idx in indices:
                 allele_eq[idx].add(eq)
 
-    return eq_idx, allele_eq, [count_unique, count_multi]
+    return eq_idx, allele_eq, [float(count_unique), float(count_multi)]
 
 
 def process_partial_counts(count_file, eq_file, allele_idx, allele_lengths,
-                           exon_idx, exon_combos):
+                           exon_idx, exon_combos, gene_codes=None):
     """Processes pseudoalignment output, returning compatibility classes."""
 
     log.info("[alignment] Processing pseudoalignment")
-    counts_index = dict()
-    with open(count_file, "r", encoding="UTF-8") as file:
-        for line in file.read().splitlines():
-            eq, count = line.split("\t")
-            counts_index[eq] = float(count)
-
-    eqs = dict()
-    with open(eq_file, "r", encoding="UTF-8") as file:
-        for line in file.read().splitlines():
-            eq, indices = line.split("\t")
-            eqs[eq] = indices.split(",")
-
-    eq_idx = {str(i): defaultdict(list) for i in exon_combos}
-    count_unique = 0
-    count_multi = 0
+    offsets, indices, counts = read_pseudoalignments(count_file, eq_file)
+    genes, class_codes, hla = classify_classes(offsets, indices, allele_idx,
+                                               gene_codes)
 
-    for eq, indices in eqs.items():
-        if [index for index in indices if not allele_idx[index]]:
-            continue
+    unique = hla & (class_codes >= 0) & (counts > 0)
+    count_unique = counts[unique].sum()
+    count_multi = counts[hla & ~unique].sum()
 
-        genes = list({allele.split("*")[0] for index in indices
-                      for allele in allele_idx[index]})
-
-        count = counts_index[eq]
+    eq_idx = {str(i): defaultdict(list) for i in exon_combos}
+    for i in np.flatnonzero(unique):
+        gene = genes[class_codes[i]]
+        class_indices = indices[offsets[i]:offsets[i + 1]].tolist()
+        count = float(counts[i])
 
-        exons = list({exon_idx[index] for index in indices})
-        if len(genes) == 1 and count > 0:
-            gene = genes[0]
-            for exon in exons:
-                exon_indices = list({index for index in indices
-                                     if exon_idx[index] == exon})
+        exons = list({exon_idx[index] for index in class_indices})
+        for exon in exons:
+            exon_indices = list({index for index in class_indices
+                                 if exon_idx[index] == exon})
 
-                eq_idx[exon][gene].append((exon_indices, count))
-            count_unique += count
-        else:
-            count_multi += count
+            eq_idx[exon][gene].append((exon_indices, count))
 
-    return eq_idx, [count_unique, count_multi]
+    return eq_idx, [float(count_unique), float(count_multi)]
 
 
 def get_count_stats(eq_idx, gene_length):
@@ -245,7 +544,10 @@ def get_count_stats(eq_idx, gene_length):
 def alignment_summary(align_stats, partial=False):
     """Prints alignment summary to log."""
 
-    count_unique, count_multi, total, _, _ = align_stats
+    count_unique, count_multi, total = align_stats[:3]
+    if len(align_stats) > 5:
+        log.info("[alignment] Sampled {:.0f} of {:.0f} reads"
+                 .format(total, align_stats[5]))
     log.info("[alignment] Processed {:.0f} reads, {:.0f} pseudoaligned "
              .format(total, count_unique + count_multi) +
              "to HLA reference")
@@ -267,84 +569,62 @@ def gene_summary(gene_stats):
                  .format(g, a * 100, c, e))
 
 
-def get_alignment(fqs, sample, reference, reference_info, outdir,
-                  temp, threads, single, partial=False, avg=200, std=20):
-    """Runs pseudoalignment and processes output."""
-    paired = not single
-
+def process_alignment(temp, sample, reference, outdir, paired, total, avg,
+                      std, sampled_from=None):
+    """Processes Kallisto output in temp with the tables of the matching
+       Reference, writing the complete or partial alignment file. The
+       number of records reads were sampled from, if any, follows the
+       alignment stats.
+    """
     count_file = "".join([temp, "pseudoalignments.tsv"])
     eq_file = "".join([temp, "pseudoalignments.ec"])
 
-    total = pseudoalign(fqs,
-                        sample,
-                        paired,
-                        reference,
-                        outdir,
-                        temp,
-                        threads,
-                        avg,
-                        std)
+    run_stats = [total, avg, std]
+    if sampled_from is not None:
+        run_stats.append(sampled_from)
 
     # Process partial genotyping pseudoalignment
-    if partial:
-        (commithash, (gene_set, allele_idx, exon_idx,
-                      lengths, partial_exons, partial_alleles)) = reference_info
-
-        gene_set = set(gene_set)
-        allele_idx = json.loads(allele_idx)
-        exon_idx = json.loads(exon_idx)
-        lengths = json.loads(lengths)
-        lengths = dict([int(a), int(x)] for a, x in lengths.items())
-        partial_exons = json.loads(partial_exons)
-        partial_alleles = set(partial_alleles)
-
+    if reference.partial:
         exon_combos = get_exon_combinations()
 
         eq_idx, align_stats = process_partial_counts(count_file,
                                                      eq_file,
-                                                     allele_idx,
-                                                     lengths,
-                                                     exon_idx,
-                                                     exon_combos)
-        align_stats.extend([total, avg, std])
+                                                     reference.allele_idx,
+                                                     reference.lengths,
+                                                     reference.exon_idx,
+                                                     exon_combos,
+                                                     (reference.genes,
+                                                      reference.gene_codes))
+        align_stats.extend(run_stats)
 
         alignment_summary(align_stats, True)
 
-        with open("".join([outdir, sample, ".partial_alignment.p"]), "wb") as file:
-            alignment_info = [commithash, eq_idx, [], paired,
-                              align_stats, []]
-            pickle.dump(alignment_info, file)
+        alignment_info = [reference.commithash, eq_idx, [], paired,
+                          align_stats, []]
+        write_alignment("".join([outdir, sample, ".partial_alignment.p"]),
+                        alignment_info, True)
 
     # Process regular pseudoalignment
     else:
-        (commithash, (gene_set, allele_idx,
-                      lengths, gene_length)) = reference_info
-
-        gene_set = set(gene_set)
-        allele_idx = json.loads(allele_idx)
-        gene_length = json.loads(gene_length)
-        gene_length = dict([a, int(x)] for a, x in gene_length.items())
-        lengths = json.loads(lengths)
-        lengths = dict([int(a), int(x)] for a, x in lengths.items())
-
         eq_idx, allele_eq, align_stats = process_counts(count_file,
                                                         eq_file,
-                                                        gene_set,
-                                                        allele_idx,
-                                                        lengths)
+                                                        reference.gene_set,
+                                                        reference.allele_idx,
+                                                        reference.lengths,
+                                                        (reference.genes,
+                                                         reference.gene_codes))
 
-        align_stats.extend([total, avg, std])
+        align_stats.extend(run_stats)
 
         alignment_summary(align_stats)
 
-        gene_stats = get_count_stats(eq_idx, gene_length)
+        gene_stats = get_count_stats(eq_idx, reference.gene_length)
         gene_summary(gene_stats)
 
-        # todo, switch to json?
-        with open("".join([outdir, sample, ".alignment.p"]), "wb") as file:
-            alignment_info = [commithash, eq_idx, allele_eq, paired,
-                              align_stats, gene_stats]
-            pickle.dump(alignment_info, file)
+        alignment_info = [reference.commithash, eq_idx, allele_eq, paired,
+                          align_stats, gene_stats]
+        write_alignment("".join([outdir, sample, ".alignment.p"]),
+                        alignment_info)
 
         with open("".join([outdir, sample, ".genes.json"]), "w") as file:
             json.dump(gene_stats, file)
@@ -352,16 +632,254 @@ def get_alignment(fqs, sample, reference, reference_info, outdir,
     return alignment_info
 
 
-def load_alignment(file, commithash, partial=False):
-    """Loads previous pseudoalignment."""
+def get_alignment(fqs, sample, index, reference, outdir, temp, threads,
+                  single, avg=200, std=20, count_reads=False,
+                  partial_index=None, partial_reference=None, collapse=False,
+                  max_reads=0, seed=0):
+    """Runs pseudoalignment against a Kallisto index and processes output
+       with the tables of the matching Reference. If a partial index and
+       reference are given, the reads are also pseudoaligned against them
+       in the same pass and the partial alignment file is written too.
+       Identical reads are pseudoaligned once if collapse is set. If
+       max_reads is set, at most that many reads or pairs are sampled.
+    """
+    paired = not single
+
+    sampled_from = None
+    if max_reads:
+        log.info("[alignment] Sampling up to %s %s (seed %s)", max_reads,
+                 "read pairs" if paired else "reads", seed)
+        sampled, records = sample_reads(fqs, "".join([temp, "sampled"]),
+                                        max_reads, seed)
+        if sampled != fqs:
+            fqs, sampled_from = sampled, records
+
+    partial_temp = None
+    if partial_index is not None:
+        partial_temp = check_path("".join([temp, "partial"]))
+
+    total = pseudoalign(fqs,
+                        sample,
+                        paired,
+                        index,
+                        outdir,
+                        temp,
+                        threads,
+                        avg,
+                        std,
+                        count_reads,
+                        partial_index,
+                        partial_temp,
+                        collapse)
+
+    alignment_info = process_alignment(temp, sample, reference, outdir,
+                                       paired, total, avg, std, sampled_from)
+
+    if partial_index is not None:
+        hline()
+        log.info("[alignment] Partial allele reference")
+        process_alignment(partial_temp, sample, partial_reference, outdir,
+                          paired, total, avg, std, sampled_from)
+
+    return alignment_info
+
+
+# -----------------------------------------------------------------------------
+# Store and load alignments
+# -----------------------------------------------------------------------------
+
+class EqClasses(Sequence):
+    """Compatibility classes of a gene held as CSR arrays, read as the usual
+       list of (indices, count) pairs.
+    """
+
+    def __init__(self, offsets, indices, counts):
+        self.offsets = offsets
+        self.indices = indices
+        self.counts = counts
+
+    @classmethod
+    def from_list(cls, eqs):
+        sizes = [len(indices) for indices, _ in eqs]
+        offsets = np.zeros(len(eqs) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        indices = np.fromiter((idx for indices, _ in eqs for idx in indices),
+                              dtype=np.int64, count=offsets[-1])
+        counts = np.array([count for _, count in eqs], dtype=float)
+        return cls(offsets, indices, counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("class index out of range")
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.indices[start:end].tolist(), float(self.counts[i])
+
+    def __iter__(self):
+        offsets = self.offsets.tolist()
+        indices = self.indices.tolist()
+        for i, count in enumerate(self.counts.tolist()):
+            yield indices[offsets[i]:offsets[i + 1]], count
+
+    def __reduce__(self):
+        return EqClasses, (np.asarray(self.offsets), np.asarray(self.indices),
+                           np.asarray(self.counts))
+
+    def allele_eq(self):
+        """Maps each reference index to the classes containing it."""
+        classes = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        order = np.argsort(self.indices, kind="stable")
+        indices, starts = np.unique(self.indices[order], return_index=True)
+        return {idx: set(eqs.tolist()) for idx, eqs
+                in zip(indices.tolist(),
+                       np.split(classes[order], starts[1:]))}
+
+
+def write_alignment(file, alignment_info, partial=False):
+    """Writes a pseudoalignment as a binary file of per-gene CSR arrays
+       after a header with the reference commithash and stats.
+    """
+    commithash, eq_idx, _, paired, align_stats, gene_stats = alignment_info
+
+    if partial:
+        groups = {exon: genes for exon, genes in eq_idx.items()}
+    else:
+        groups = {None: eq_idx}
+
+    classes = []
+    arrays = dict()
+    for exon, genes in groups.items():
+        for gene, eqs in genes.items():
+            if not isinstance(eqs, EqClasses):
+                eqs = EqClasses.from_list(eqs)
+
+            name = gene if exon is None else f"{exon}/{gene}"
+            classes.append({"exon": exon, "gene": gene, "name": name})
+            arrays[name + "/offsets"] = eqs.offsets
+            arrays[name + "/indices"] = np.asarray(eqs.indices, dtype=np.int32)
+            arrays[name + "/counts"] = eqs.counts
+
+    header = {"version": alignment_version,
+              "commithash": commithash,
+              "paired": paired,
+              "partial": partial,
+              "align_stats": align_stats,
+              "gene_stats": gene_stats,
+              "exons": list(eq_idx) if partial else None,
+              "classes": classes}
+
+    write_container(file, alignment_magic, header, arrays)
+
+
+def read_alignment(file, partial=False, genes=None):
+    """Reads a binary pseudoalignment, memory-mapping the classes of the
+       genes given, or of all genes.
+    """
+    header, _ = read_header(file, alignment_magic)
+
+    if header["version"] > alignment_version:
+        sys.exit(f"[alignment] Error: {file} was written by a newer " +
+                 "version of arcasHLA")
+
+    if genes is not None:
+        genes = set(genes)
+        header["classes"] = [entry for entry in header["classes"]
+                             if entry["gene"] in genes]
+
+    names = [entry["name"] + suffix for entry in header["classes"]
+             for suffix in ("/offsets", "/indices", "/counts")]
+    _, arrays = read_container(file, alignment_magic, names)
+
+    def get_eqs(name):
+        return EqClasses(arrays[name + "/offsets"],
+                         arrays[name + "/indices"],
+                         arrays[name + "/counts"])
+
+    if partial:
+        eq_idx = {exon: defaultdict(list) for exon in header["exons"]}
+        for entry in header["classes"]:
+            eq_idx[entry["exon"]][entry["gene"]] = get_eqs(entry["name"])
+        allele_eq = []
+    else:
+        eq_idx = {entry["gene"]: get_eqs(entry["name"])
+                  for entry in header["classes"]}
+        allele_eq = defaultdict(set)
+        for eqs in eq_idx.values():
+            allele_eq.update(eqs.allele_eq())
+
+    return [header["commithash"], eq_idx, allele_eq, header["paired"],
+            header["align_stats"], header["gene_stats"]]
+
+
+def select_genes(alignment_info, genes, partial=False):
+    """Keeps the compatibility classes of the given genes."""
+    commithash, eq_idx, allele_eq, paired, align_stats, gene_stats = \
+        alignment_info
+    genes = set(genes)
+
+    if partial:
+        eq_idx = {exon: defaultdict(list, {gene: eqs for gene, eqs
+                                           in exon_eqs.items()
+                                           if gene in genes})
+                  for exon, exon_eqs in eq_idx.items()}
+    else:
+        eq_idx = {gene: eqs for gene, eqs in eq_idx.items() if gene in genes}
+
+        if allele_eq:
+            indices = {idx for eqs in eq_idx.values()
+                       for class_indices, _ in eqs for idx in class_indices}
+            allele_eq = {idx: eqs for idx, eqs in allele_eq.items()
+                         if idx in indices}
+
+    return [commithash, eq_idx, allele_eq, paired, align_stats, gene_stats]
+
+
+def intern_alignment(alignment_info, partial=False):
+    """Converts compatibility classes indexed by decimal strings to
+       integer IDs.
+    """
+    commithash, eq_idx, allele_eq, paired, align_stats, gene_stats = \
+        alignment_info
+
+    def intern_eqs(eqs):
+        return [([int(idx) for idx in indices], count)
+                for indices, count in eqs]
+
+    if partial:
+        eq_idx = {exon: {gene: intern_eqs(eqs) for gene, eqs in genes.items()}
+                  for exon, genes in eq_idx.items()}
+    else:
+        eq_idx = {gene: intern_eqs(eqs) for gene, eqs in eq_idx.items()}
+
+    if allele_eq:
+        allele_eq = defaultdict(set, {int(idx): eqs
+                                      for idx, eqs in allele_eq.items()})
+
+    return [commithash, eq_idx, allele_eq, paired, align_stats, gene_stats]
+
+
+def load_alignment(file, commithash, partial=False, genes=None):
+    """Loads previous pseudoalignment, keeping only the classes of the genes
+       given. Gene stats are kept for every gene.
+    """
 
     log.info("[alignment] Loading previous alignment %s", file)
 
+    if is_container(file, alignment_magic):
+        alignment_info = read_alignment(file, partial, genes)
+        return check_alignment(alignment_info, commithash, partial)
+
     with open(file, "rb") as file:
         alignment_info = pickle.load(file)
 
     # Compatibility with arcasHLA 1.0
-    if len(alignment_info) != 5:
+    if len(alignment_info) != 6:
         if partial:
             (commithash_alignment, eq_idx, paired,
              _, _, _, _) = alignment_info
@@ -370,10 +888,21 @@ def load_alignment(file, commithash, partial=False):
         else:
             (commithash_alignment, eq_idx, allele_eq, paired,
              align_stats, gene_stats, num, avg, std) = alignment_info
-            align_stats = align_stats.extend([num, avg, std])
+            align_stats.extend([num, avg, std])
             alignment_info = [commithash, eq_idx, allele_eq, paired,
                               align_stats, gene_stats]
 
+    if genes is not None:
+        alignment_info = select_genes(alignment_info, genes, partial)
+
+    # Compatibility with alignments indexed by decimal strings
+    alignment_info = intern_alignment(alignment_info, partial)
+
+    return check_alignment(alignment_info, commithash, partial)
+
+
+def check_alignment(alignment_info, commithash, partial=False):
+    """Checks a loaded alignment against the reference and summarizes it."""
     commithash_alignment, _, _, _, align_stats, gene_stats = alignment_info
 
     if commithash != commithash_alignment:
@@ -26,6 +26,9 @@ import logging as log
 import os
 import re
 import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
 from subprocess import PIPE, run
 
 # -------------------------------------------------------------------------------
@@ -36,24 +39,70 @@ __date__ = "2022-01-27"
 
 # -------------------------------------------------------------------------------
 
-def process_allele(allele, n, keep_alpha=True):
-    """Lowers allele resolution to n-fields."""
-    alpha = False
-    fields = allele.split(":")
+AlleleName = namedtuple("AlleleName", ["gene", "fields", "suffix"])
+
 
-    if fields[-1][-1].isalpha():
-        if keep_alpha and len(fields) < 3:
-            alpha = fields[-1][-1]
+@lru_cache(maxsize=None)
+def parse_allele(allele):
+    """Parses an allele name into its gene, fields and expression suffix."""
+    gene, _, name = allele.rpartition("*")
+    fields = name.split(":")
+
+    suffix = fields[-1][-1:]
+    if suffix.isalpha():
         fields[-1] = fields[-1][:-1]
+    else:
+        suffix = ""
+
+    return AlleleName(gene, tuple(fields), suffix)
 
-    out = fields[:n]
-    out = ":".join(out)
 
-    if alpha:
-        out += alpha
+def process_allele(allele, n, keep_alpha=True):
+    """Lowers allele resolution to n-fields."""
+    gene, fields, suffix = parse_allele(allele)
+
+    out = ":".join(fields[:n])
+    if gene:
+        out = gene + "*" + out
+
+    if keep_alpha and len(fields) < 3:
+        out += suffix
     return out
 
 
+class AlleleIndex(list):
+    """Alleles of each reference sequence, indexed by integer ID. Names are
+       parsed once per reference and kept at 1, 2 and 3-field resolution.
+    """
+
+    def __init__(self, allele_idx, resolutions=None):
+        super().__init__(allele_idx)
+        if resolutions is None:
+            resolutions = {n: [alleles and tuple(process_allele(allele, n)
+                                                 for allele in alleles)
+                               for alleles in self]
+                           for n in (1, 2, 3)}
+        self.resolutions = resolutions
+
+    def names(self, idx, n):
+        """Returns the n-field names of a sequence's alleles."""
+        return self.resolutions[n][idx]
+
+    def name(self, idx, n):
+        """Returns the n-field name a sequence is reported as."""
+        return self.resolutions[n][idx][0]
+
+
+def intern_indices(table, default=None):
+    """Converts a table keyed by decimal reference indices into a list
+       indexed by integer ID.
+    """
+    interned = [default] * (max(int(idx) for idx in table) + 1)
+    for idx, value in table.items():
+        interned[int(idx)] = value
+    return interned
+
+
 def get_gene(allele):
     """Returns gene of an allele."""
     return allele.split("*")[0]
@@ -110,4 +159,33 @@ def create_temp(temp):
 def hline():
     log.info("-" * 80)
 
+
+class LogBuffer(log.Handler):
+    """Collects formatted log messages in a list."""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+@contextmanager
+def capture_log():
+    """Redirects log messages to a list for the duration of the block, so
+       output from worker processes can be written to the log in order.
+    """
+    logger = log.getLogger()
+    handlers, level = logger.handlers, logger.level
+    buffer = LogBuffer()
+
+    logger.handlers = [buffer]
+    logger.setLevel(log.DEBUG)
+    try:
+        yield buffer.messages
+    finally:
+        logger.handlers = handlers
+        logger.setLevel(level)
+
 # -------------------------------------------------------------------------------
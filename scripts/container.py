@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+#   container.py: binary files of named arrays that can be memory-mapped.
+# -------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------
+#   This file is part of arcasHLA.
+#
+#   arcasHLA is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   arcasHLA is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with arcasHLA.  If not, see <https://www.gnu.org/licenses/>.
+# -------------------------------------------------------------------------------
+
+import json
+import struct
+import zlib
+
+import numpy as np
+
+# -------------------------------------------------------------------------------
+
+__version__ = "0.4.0"
+__date__ = "2022-01-27"
+
+# -------------------------------------------------------------------------------
+
+# Layout: 8 byte magic, little-endian uint64 header length, JSON header,
+# then each array starting on a multiple of BLOCK bytes from the data start.
+# The header records the dtype, shape, offset and CRC-32 of every array.
+BLOCK = 64
+
+
+def padding(size):
+    """Returns the bytes needed to pad size to a multiple of BLOCK."""
+    return -size % BLOCK
+
+
+def is_container(file, magic):
+    """Checks if a file starts with the given magic bytes."""
+    with open(file, "rb") as handle:
+        return handle.read(len(magic)) == magic
+
+
+def write_container(file, magic, header, arrays):
+    """Writes named arrays after a JSON header."""
+    layout = dict()
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        layout[name] = {"dtype": array.dtype.str,
+                        "shape": list(array.shape),
+                        "offset": offset,
+                        "crc32": zlib.crc32(array.data)}
+        offset += array.nbytes + padding(array.nbytes)
+
+    header = json.dumps(dict(header, arrays=layout)).encode()
+    prefix = magic + struct.pack("<Q", len(header)) + header
+
+    with open(file, "wb") as handle:
+        handle.write(prefix + bytes(padding(len(prefix))))
+        for array in arrays.values():
+            array = np.ascontiguousarray(array)
+            handle.write(array.data)
+            handle.write(bytes(padding(array.nbytes)))
+
+
+def read_header(file, magic):
+    """Returns the header of a container and the offset of its data."""
+    with open(file, "rb") as handle:
+        if handle.read(len(magic)) != magic:
+            raise ValueError(f"{file} is not a {magic.decode()} file")
+        (length,) = struct.unpack("<Q", handle.read(8))
+        header = json.loads(handle.read(length))
+
+    start = len(magic) + 8 + length
+    return header, start + padding(start)
+
+
+def read_container(file, magic, names=None, verify=True):
+    """Memory-maps a container, returning its header and the arrays in
+       names, or all arrays. Checks each array returned against its CRC-32
+       if verify is set.
+    """
+    header, start = read_header(file, magic)
+    layout = header["arrays"]
+    if names is None:
+        names = list(layout)
+
+    data = np.memmap(file, dtype=np.uint8, mode="r")
+
+    arrays = dict()
+    for name in names:
+        entry = layout[name]
+        dtype = np.dtype(entry["dtype"])
+        size = dtype.itemsize * int(np.prod(entry["shape"]))
+        offset = start + entry["offset"]
+        array = data[offset:offset + size]
+
+        if verify and zlib.crc32(array) != entry["crc32"]:
+            raise ValueError(f"{file} is corrupted: checksum of {name} " +
+                             "does not match")
+
+        arrays[name] = array.view(dtype).reshape(entry["shape"])
+
+    return header, arrays
+
+# -------------------------------------------------------------------------------
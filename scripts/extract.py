@@ -26,8 +26,11 @@ import argparse
 import json
 import sys
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from os.path import isfile
+from subprocess import DEVNULL, PIPE, Popen
+from threading import Lock
 
 from arcas_utilities import *
 
@@ -51,20 +54,207 @@ def index_bam(bam):
         sys.exit("[extract] Error: unable to index bam file.")
 
 
-def extract_reads(bam, outdir, paired, unmapped, alts, temp, threads):
-    """Extracts reads from chromosome 6 and alts/decoys if applicable."""
+def get_sequence_lengths(header):
+    """Returns the length of each reference sequence in a SAM header."""
+    lengths = dict()
+    for line in header.splitlines():
+        if not line.startswith("@SQ"):
+            continue
+        fields = dict(field.split(":", 1) for field in line.split("\t")[1:])
+        lengths[fields["SN"]] = int(fields["LN"])
+    return lengths
+
+
+def get_regions(lengths, chrom, alts, mhc_regions):
+    """Returns BED regions covering the MHC on chromosome 6, picked by the
+       length of chromosome 6 in the BAM's build, and every alt/decoy contig
+       in the BAM. Falls back to all of chromosome 6 for unknown builds.
+       Returns the regions and the build, or None if unknown.
+    """
+    regions = []
+    build = None
+    for name, region in mhc_regions.items():
+        if lengths.get(chrom) == region["length"]:
+            build = name
+            regions.append((chrom, region["start"], region["end"]))
+            break
+    else:
+        if chrom in lengths:
+            regions.append((chrom, 0, lengths[chrom]))
+
+    for alt in alts:
+        if alt in lengths:
+            regions.append((alt, 0, lengths[alt]))
+
+    return regions, build
+
+
+def get_sort_order(header):
+    """Returns the sort order declared in a SAM header, or None."""
+    for line in header.splitlines():
+        if line.startswith("@HD"):
+            for field in line.split("\t")[1:]:
+                if field.startswith("SO:"):
+                    return field[3:]
+    return None
+
+
+def mates_grouped(header, paired):
+    """Checks if reads need no collation: single-end reads or BAMs already
+       sorted by name.
+    """
+    return not paired or get_sort_order(header) == "queryname"
+
+
+def split_threads(threads, n_views, collate, level):
+    """Splits one budget of samtools worker threads between the views run at
+       once, collation and FASTQ compression. Returns the threads of all
+       views together, of collate and of fastq, which add up to the budget.
+    """
+    threads = int(threads)
+    fastq_threads = threads // 4 if level else 0
+    collate_threads = threads // 8 if collate else 0
+
+    # Views are given equal shares, the rest goes to compression
+    view_threads = threads - fastq_threads - collate_threads
+    workers = max(1, min(view_threads, n_views))
+    fastq_threads += view_threads % workers
+    view_threads -= view_threads % workers
+
+    return view_threads, collate_threads, fastq_threads
+
+
+def group_mates(paired, temp, sample, threads):
+    """Returns the command grouping mates for samtools fastq. Mates are
+       collated in a hash table and written as soon as both are seen, only
+       spilling reads whose mate is far away to temp. Returns None for
+       single-end reads.
+    """
+    if not paired:
+        return None
+
+    return " ".join(["samtools collate -O -f -l 1", "-@" + str(threads), "-",
+                     "".join([temp, sample, ".collate"])])
+
+
+def fastq_command(fqs, threads, level):
+    """Returns the samtools fastq command writing mate-grouped reads from
+       stdin, which compresses both mates at the same time on its own
+       threads. FASTQs are gzipped unless the compression level is 0.
+    """
+    if level:
+        fqs = ["".join([fq, ".gz"]) for fq in fqs]
+
+    # Paired reads whose mate was not extracted are discarded
+    if len(fqs) > 1:
+        outputs = ["-1", fqs[0], "-2", fqs[1], "-0 /dev/null -s /dev/null"]
+    else:
+        outputs = ["-0", fqs[0], "-o", fqs[0]]
+
+    return " ".join(["samtools fastq -n", "-c", str(level),
+                     "-@" + str(threads)] + outputs + ["-"])
+
+
+def stream_views(views, header, command, temp, threads, message,
+                 chunk_size=1024 * 1024):
+    """Runs samtools view with each list of arguments concurrently, sharing
+       threads between at most threads views at a time, piping their SAM
+       records after the header into a single command. Records are written
+       whole lines at a time, so the views interleave without splitting
+       them.
+    """
+    workers = max(1, min(int(threads), len(views)))
+    view_threads = "-@" + str(max(1, int(threads) // workers))
+    views = [["samtools", "view", view_threads] + view for view in views]
+
+    log.info("{}\n\n\t{}\n\t| {}\n".format(
+        message, "\n\t".join(" ".join(view) for view in views), command))
+
+    command_log = "".join([temp, "convert.log"])
+    with open(command_log, "wb") as stderr:
+        process = Popen(command, shell=True, stdin=PIPE, stdout=DEVNULL,
+                        stderr=stderr)
+    try:
+        process.stdin.write(header.encode())
+    except BrokenPipeError:
+        pass
+
+    lock = Lock()
+    errors = []
+
+    # Runs a view, writing complete lines of its output under the lock. The
+    # view is stopped if the command exits early, which is reported below
+    def run_view(i, view):
+        view_log = "".join([temp, "view_", str(i), ".log"])
+        with open(view_log, "wb") as stderr:
+            producer = Popen(view, stdout=PIPE, stderr=stderr)
+
+        rest = b""
+        try:
+            while chunk := producer.stdout.read(chunk_size):
+                rest += chunk
+                end = rest.rfind(b"\n") + 1
+                if end:
+                    with lock:
+                        process.stdin.write(rest[:end])
+                    rest = rest[end:]
+            if rest:
+                with lock:
+                    process.stdin.write(rest)
+        except BrokenPipeError:
+            producer.kill()
+            producer.stdout.close()
+            producer.wait()
+            return
+        producer.stdout.close()
+
+        if producer.wait() != 0:
+            with open(view_log, "r") as handle:
+                errors.append("\t{}\n\t{}".format(" ".join(view),
+                                                   handle.read().strip()))
+
+    with ThreadPoolExecutor(workers) as executor:
+        for future in [executor.submit(run_view, i, view)
+                       for i, view in enumerate(views)]:
+            future.result()
+
+    # A failed view leaves the FASTQs incomplete, so conversion is stopped
+    if errors:
+        process.kill()
+    try:
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    process.wait()
+
+    with open(command_log, "r") as handle:
+        stderr = "\t" + re.sub("\n", "\n\t", handle.read())
+    if len(stderr) > 1:
+        log.info(stderr)
+
+    if errors:
+        sys.exit("[extract] Error: samtools view failed.\n" +
+                 "\n".join(errors))
+    if process.returncode != 0:
+        sys.exit("[extract] Error: could not convert reads to fastq.")
+
+
+def extract_reads(bam, outdir, paired, unmapped, alts, temp, threads,
+                  mhc_regions=None, level=6):
+    """Extracts reads from chromosome 6 and alts/decoys if applicable. If
+       MHC regions are given, only reads in the MHC and alts/decoys are
+       extracted in a single query, together with their mates. The queries
+       run concurrently and are streamed through mate collation into FASTQs
+       compressed at the given level.
+    """
 
     log.info(f"[extract] Extracting reads from {bam}")
 
-    file_list = []
     sample = os.path.splitext(os.path.basename(bam))[0]
 
     # Index bam
     index_bam(bam)
 
-    hla_filtered = "".join([temp, sample, ".hla.sam"])
-    file_list.append(hla_filtered)
-
     # Get bam header to check for chromosome nomenclature
     output = run_command(["samtools", "view", "-@" + threads, "-H", bam])
     header = output.stdout.decode("utf-8")
@@ -74,104 +264,105 @@ def extract_reads(bam, outdir, paired, unmapped, alts, temp, threads):
     else:
         chrom = "6"
 
-    # Extract BAM header
-    message = "[extract] Extracting chromosome 6: "
-    command = ["samtools", "view", "-H", "-@" + threads]
-    command.extend([bam, "-o", hla_filtered])
-    run_command(command, message)
-
-    # Extracted reads mapped to chromosome 6
-    message = "[extract] Extracting chromosome 6: "
-    command = ["samtools", "view", "-@" + threads]
     if paired:
-        command.append("-f 2")
+        mapped = "-f 2"
     else:
-        command.append("-F 4")
-    command.extend([bam, chrom, ">>", hla_filtered])
-    run_command(command, message)
+        mapped = "-F 4"
+
+    # Queries whose SAM records are streamed after the header
+    views = []
+
+    # Extract reads in the MHC and alts/decoys, fetching mates that map
+    # outside of them
+    if mhc_regions is not None:
+        regions, build = get_regions(get_sequence_lengths(header), chrom,
+                                     alts, mhc_regions)
+        if build is None:
+            log.info("[extract] Build not recognized from the length of " +
+                     "chromosome 6, extracting all of chromosome 6")
+        else:
+            log.info(f"[extract] Build: {build}")
 
-    # Extract unmapped reads
-    if unmapped:
-        message = "[extract] Extracting unmapped reads: "
-        command = ["samtools", "view", "-@" + threads]
+        bed = "".join([temp, sample, ".regions.bed"])
+        with open(bed, "w") as file:
+            for region in regions:
+                file.write("{}\t{}\t{}\n".format(*region))
 
-        if paired:
-            command.append("-f 12")
-        else:
-            command.append("-f 4")
+        views.append(mapped.split() + ["--fetch-pairs" if paired else "-M",
+                                       "-L", bed, bam])
 
-        command.extend([bam, ">>", hla_filtered])
-        run_command(command, message)
+    # Extracted reads mapped to chromosome 6 and alts/decoys in the header
+    else:
+        views.append(mapped.split() + [bam, chrom])
+        for alt in alts:
+            if alt in header:
+                views.append(mapped.split() + [bam, alt + ":"])
+
+    # Extract unmapped reads
+    if unmapped:
+        views.append(["-f", "12" if paired else "4", bam])
 
-    # Check for alts in header and extract reads if present
-    for alt in alts:
-        if alt in header:
-            command = ["samtools", "view", "-@" + threads]
-
-            if paired:
-                command.append("-f 2")
-            else:
-                command.append("-F 4")
-
-            command.extend([bam, alt + ":", ">>", hla_filtered])
-            run_command(command)
-
-    # Sort and convert to BAM
-    hla_sorted = "".join([temp, sample, ".hla.sorted.bam"])
-    file_list.append(hla_sorted)
-    file_list.append(hla_sorted + ".bai")
-    message = "[extract] Sorting bam: "
-    command = ["samtools", "sort", "-n", "-@" + threads,
-               hla_filtered, "-o", hla_sorted]
-    run_command(command, message)
-
-    # Convert BAM to FASTQ and compress
-    message = "[extract] Converting bam to fastq: "
-    command = ["bedtools", "bamtofastq", "-i", hla_sorted]
     if paired:
-        fq1 = "".join([outdir, sample, ".extracted.1.fq"])
-        fq2 = "".join([outdir, sample, ".extracted.2.fq"])
-        command.extend(["-fq", fq1, "-fq2", fq2])
-        run_command(command, message)
+        fqs = ["".join([outdir, sample, ".extracted.1.fq"]),
+               "".join([outdir, sample, ".extracted.2.fq"])]
+    else:
+        fqs = ["".join([outdir, sample, ".extracted.fq"])]
 
-        run_command(["pigz", "-f", "-p", threads, "-S", ".gz", fq1])
-        run_command(["pigz", "-f", "-p", threads, "-S", ".gz", fq2])
+    # Group mates of the extracted reads and write them to FASTQ, sharing
+    # the threads with the views. The views are interleaved, so mates are
+    # collated even if the BAM is sorted by name.
+    view_threads, collate_threads, fastq_threads = split_threads(
+        threads, len(views), paired, level)
+    command = " | ".join(filter(None, [
+        group_mates(paired, temp, sample, collate_threads),
+        fastq_command(fqs, fastq_threads, level)]))
 
-    else:
-        fq = "".join([outdir, sample, ".extracted.fq"])
-        command.extend(["-fq", fq])
-        run_command(command, message)
-        run_command(["pigz", "-f", "-p", threads, "-S", ".gz", fq])
+    stream_views(views, header, command, temp, view_threads,
+                 "[extract] Extracting reads to fastq: ")
 
 
-def bam_to_fastq(bam, outdir, paired, temp, threads):
-    """Converts bam to fastq"""
+def bam_to_fastq(bam, outdir, paired, temp, threads, level=6):
+    """Converts bam to fastq. The BAM is read whole, so it does not need to
+       be indexed or sorted by coordinate.
+    """
 
     log.info(f"[extract] Extracting reads from {bam}")
 
-    file_list = []
     sample = os.path.splitext(os.path.basename(bam))[0]
 
-    # Index bam
-    index_bam(bam)
+    output = run_command(["samtools", "view", "-@" + threads, "-H", bam])
+    header = output.stdout.decode("utf-8")
 
-    # Convert BAM to FASTQ and compress
-    message = "[extract] Converting bam to fastq: "
-    command = ["bedtools", "bamtofastq", "-i", bam]
+    # Convert BAM to FASTQ
     if paired:
-        fq1 = "".join([outdir, sample, ".1.fq"])
-        fq2 = "".join([outdir, sample, ".2.fq"])
-        command.extend(["-fq", fq1, "-fq2", fq2])
-        run_command(command, message)
+        fqs = ["".join([outdir, sample, ".1.fq"]),
+               "".join([outdir, sample, ".2.fq"])]
+    else:
+        fqs = ["".join([outdir, sample, ".fq"])]
 
-        run_command(["pigz", "-f", "-p", threads, "-S", ".gz", fq1])
-        run_command(["pigz", "-f", "-p", threads, "-S", ".gz", fq2])
+    # Mates of BAMs sorted by name are already next to each other
+    collate = not mates_grouped(header, paired)
+    view_threads, collate_threads, fastq_threads = split_threads(
+        threads, 1, collate, level)
+    command = [" ".join(["samtools view -u", "-@" + str(view_threads), bam])]
+    if collate:
+        command.append(group_mates(paired, temp, sample, collate_threads))
+    command.append(fastq_command(fqs, fastq_threads, level))
 
-    else:
-        fq = "".join([outdir, sample, ".fq"])
-        command.extend(["-fq", fq])
-        run_command(command, message)
-        run_command(["pigz", "-f", "-p", threads, "-S", ".gz", fq])
+    output = run_command(" | ".join(filter(None, command)),
+                         "[extract] Converting bam to fastq: ")
+    if output.returncode != 0:
+        sys.exit("[extract] Error: could not convert bam to fastq.")
+
+
+def arg_check_level(parser, arg):
+    try:
+        value = int(arg)
+    except ValueError:
+        parser.error("The compression level must be an integer.")
+    if value < 0 or value > 9:
+        parser.error("The compression level must be between 0 and 9.")
+    return value
 
 
 # -------------------------------------------------------------------------------
@@ -211,11 +402,27 @@ if __name__ == "__main__":
                         help="include unmapped reads\n  default: False\n\n",
                         default=False)
 
+    parser.add_argument("--mhc",
+                        action="count",
+                        help="extract reads in the MHC region and HLA " +
+                             "alts/decoys only, with their\n  mates, " +
+                             "instead of all of chromosome 6\n  " +
+                             "default: False\n\n",
+                        default=False)
+
     parser.add_argument("--allreads",
                         action="count",
                         help="output all reads to fastq\n  default: False\n\n",
                         default=False)
 
+    parser.add_argument("--level",
+                        type=lambda x: arg_check_level(parser, x),
+                        help="gzip compression level of the FASTQs, 1 " +
+                             "is fastest and 0 writes\n  uncompressed " +
+                             "FASTQs\n  default: 6\n\n",
+                        default=6,
+                        metavar="")
+
     parser.add_argument("-o", "--outdir",
                         type=str,
                         help="out directory\n\n",
@@ -285,8 +492,15 @@ if __name__ == "__main__":
     with open(datDir + "info/decoys_alts.json", "r") as file:
         alts = json.load(file)
 
+    # Load MHC coordinates of each build
+    mhc_regions = None
+    if args.mhc:
+        with open(datDir + "info/mhc_regions.json", "r") as file:
+            mhc_regions = json.load(file)
+
     if args.allreads:
-        bam_to_fastq(args.bam, outdir, not args.single, temp, args.threads)
+        bam_to_fastq(args.bam, outdir, not args.single, temp, args.threads,
+                     args.level)
 
     else:
         extract_reads(args.bam,
@@ -295,7 +509,9 @@ if __name__ == "__main__":
                       args.unmapped,
                       alts,
                       temp,
-                      args.threads)
+                      args.threads,
+                      mhc_regions,
+                      args.level)
 
     remove_files(temp, args.keep_files)
 
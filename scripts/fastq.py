@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+#   fastq.py: streaming statistics for plain and gzipped FASTQ files.
+# -------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------
+#   This file is part of arcasHLA.
+#
+#   arcasHLA is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   arcasHLA is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with arcasHLA.  If not, see <https://www.gnu.org/licenses/>.
+# -------------------------------------------------------------------------------
+
+import gzip
+import math
+from collections import defaultdict, namedtuple
+from itertools import count, islice
+
+import numpy as np
+
+# -------------------------------------------------------------------------------
+
+__version__ = "0.4.0"
+__date__ = "2022-01-27"
+
+# -------------------------------------------------------------------------------
+
+FastqStats = namedtuple("FastqStats", ["records", "length_histogram"])
+
+
+def open_fastq(fq):
+    """Opens a FASTQ file for binary reading, decompressing it if gzipped."""
+    with open(fq, "rb") as file:
+        magic = file.read(2)
+
+    if magic == b"\x1f\x8b":
+        return gzip.open(fq, "rb")
+    return open(fq, "rb")
+
+
+def count_records(fq, chunk_size=4 * 1024 * 1024):
+    """Counts FASTQ records by counting lines in fixed size chunks."""
+    lines = 0
+    last = b"\n"
+    with open_fastq(fq) as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            lines += chunk.count(b"\n")
+            last = chunk[-1:]
+
+    # Counts a final line without a trailing newline
+    if last != b"\n":
+        lines += 1
+
+    # Every record whose sequence line was read, as for a truncated file
+    return (lines + 2) // 4
+
+
+def read_length_histogram(fq, max_length=1000):
+    """Returns the number of records of each read length. The last bin
+       counts reads of max_length or longer.
+    """
+    histogram = np.zeros(max_length + 1, dtype=np.int64)
+    chunk = np.empty(65536, dtype=np.int64)
+
+    with open_fastq(fq) as file:
+        sequences = islice(file, 1, None, 4)
+        while True:
+            n = 0
+            for line in islice(sequences, len(chunk)):
+                chunk[n] = len(line.rstrip())
+                n += 1
+            if not n:
+                break
+            histogram += np.bincount(np.minimum(chunk[:n], max_length),
+                                     minlength=max_length + 1)
+
+    return histogram
+
+
+def collapse_reads(fqs, prefix):
+    """Collapses identical reads, or identical pairs across paired FASTQs,
+       into unique sequences with multiplicities. Each unique read is written
+       to prefix.{bit}.{mate}.fq for every bit set in its multiplicity, so
+       that class counts from the files of each bit, scaled by 2 ** bit, sum
+       to those of the full input. Returns the FASTQs of each bit, the number
+       of records read and the number of unique reads.
+    """
+    counts = defaultdict(int)
+    files = [open_fastq(fq) for fq in fqs]
+    try:
+        sequences = [islice(file, 1, None, 4) for file in files]
+        for reads in zip(*sequences):
+            counts[b"\t".join(read.rstrip() for read in reads)] += 1
+    finally:
+        for file in files:
+            file.close()
+
+    # Bits set in any multiplicity
+    used = 0
+    for count in counts.values():
+        used |= count
+
+    records = sum(counts.values()) * len(fqs)
+    outputs = {bit: ["{}.{}.{}.fq".format(prefix, bit, mate)
+                     for mate in range(1, len(fqs) + 1)]
+               for bit in range(used.bit_length()) if used >> bit & 1}
+
+    handles = {bit: [open(fq, "wb") for fq in fqs]
+               for bit, fqs in outputs.items()}
+    try:
+        for i, (key, count) in enumerate(counts.items()):
+            reads = key.split(b"\t")
+            for bit in range(count.bit_length()):
+                if count >> bit & 1:
+                    for handle, read in zip(handles[bit], reads):
+                        handle.write(b"@%d\n%s\n+\n%s\n"
+                                     % (i, read, b"I" * len(read)))
+    finally:
+        for bit_handles in handles.values():
+            for handle in bit_handles:
+                handle.close()
+
+    return outputs, records, len(counts)
+
+
+def sample_reads(fqs, prefix, max_reads, seed=0):
+    """Reservoir samples up to max_reads reads, or read pairs across paired
+       FASTQs, in a single pass and writes them in input order to
+       prefix.{mate}.fq. Returns the FASTQs to align, which are the input
+       FASTQs if they hold no more than max_reads, and the number of records
+       read.
+    """
+    rng = np.random.default_rng(seed)
+    files = [open_fastq(fq) for fq in fqs]
+    try:
+        # Records of each mate with their position, which is counted last
+        # so that the position is not advanced once the FASTQs run out
+        positions = count()
+        records = zip(*[zip(file, file, file, file) for file in files],
+                      positions)
+        reservoir = list(islice(records, max_reads))
+
+        # Algorithm L, skipping records that are not sampled
+        if len(reservoir) == max_reads:
+            w = math.exp(math.log(1 - rng.random()) / max_reads)
+            while True:
+                skip = math.floor(math.log(1 - rng.random()) /
+                                  math.log(1 - w))
+                record = next(islice(records, skip, None), None)
+                if record is None:
+                    break
+                reservoir[rng.integers(max_reads)] = record
+                w *= math.exp(math.log(1 - rng.random()) / max_reads)
+
+        total = next(positions)
+    finally:
+        for file in files:
+            file.close()
+
+    if total <= max_reads:
+        return fqs, total * len(fqs)
+
+    outputs = ["{}.{}.fq".format(prefix, mate)
+               for mate in range(1, len(fqs) + 1)]
+    reservoir.sort(key=lambda record: record[-1])
+    for mate, output in enumerate(outputs):
+        with open(output, "wb") as file:
+            for record in reservoir:
+                file.writelines(record[mate])
+                if not record[mate][-1].endswith(b"\n"):
+                    file.write(b"\n")
+
+    return outputs, total * len(fqs)
+
+
+def fastq_stats(fqs, histogram=False, max_length=1000):
+    """Counts records across FASTQ files in constant memory, optionally
+       with a read length histogram bounded at max_length.
+    """
+    if not histogram:
+        return FastqStats(sum(count_records(fq) for fq in fqs), None)
+
+    length_histogram = sum(read_length_histogram(fq, max_length) for fq in fqs)
+    return FastqStats(int(length_histogram.sum()), length_histogram)
+
+# -------------------------------------------------------------------------------
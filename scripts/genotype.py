@@ -24,13 +24,17 @@
 
 import argparse
 import math
+import time
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
-from itertools import combinations
 from textwrap import wrap
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
+import kernels
 from align import *
 from reference import check_ref
 
@@ -47,9 +51,14 @@ rootDir = os.path.dirname(os.path.realpath(__file__)) + "/../"
 
 hla_json = rootDir + "dat/ref/hla.p.json"
 hla_idx = rootDir + "dat/ref/hla.idx"
+partial_json = rootDir + "dat/ref/hla_partial.p.json"
+partial_idx = rootDir + "dat/ref/hla_partial.idx"
 hla_freq = rootDir + "dat/info/hla_freq.tsv"
 parameters_json = rootDir + "dat/info/parameters.json"
 
+# Genes with population allele frequencies
+prior_genes = {"A", "B", "C", "DRB1", "DQB1", "DQA1"}
+
 
 # -----------------------------------------------------------------------------
 # Genotype
@@ -57,183 +66,254 @@ parameters_json = rootDir + "dat/info/parameters.json"
 
 def expectation_maximization(eqs, lengths, allele_idx, population, prior,
                              tolerance, max_iterations, drop_iterations,
-                             drop_threshold):
+                             drop_threshold, trace=None,
+                             replicate_counts=None):
     """Quantifies allele transcript abundance. Based on the methods
        used in HISAT-genotype (http://dx.doi.org/10.1101/266197).
-    """
-
-    # Divides raw counts between alleles for the first iteration
-    # of transcript quantification
-    def initial_abundances(eqs, lengths, population):
 
-        # Divides counts equally between alleles in the same compatibility class
-        def divide_equally(alleles, count):
-            n_alleles = len(alleles)
-            for allele in alleles:
-                counts[allele] += count / n_alleles
+       If replicate_counts, a classes by replicates matrix, is given, it
+       replaces the counts of eqs and a result is returned for each
+       replicate. Replicates are run together, each stopping as it
+       converges. If a trace list is given, appends a record of each
+       SQUAREM iteration of a single run.
+    """
 
-        # Divides counts proportionally to allele frequency
-        def divide_prior(alleles, count, allele_prob):
-            total_prob = sum(allele_prob.values())
+    # Builds a sparse compatibility class by allele matrix, with alleles
+    # indexed in order of first appearance
+    def build_matrix(eqs):
+        columns = dict()
+        indptr = [0]
+        indices = []
+        for alleles, _ in eqs:
             for allele in alleles:
-                counts[allele] += count * (allele_prob[allele] / total_prob)
+                indices.append(columns.setdefault(allele, len(columns)))
+            indptr.append(len(indices))
 
-        counts = defaultdict(float)
-        undivided_counts = defaultdict(float)
-        for alleles, count in eqs:
+        matrix = sparse.csr_matrix((np.ones(len(indices)), indices, indptr),
+                                   shape=(len(eqs), len(columns)))
 
-            allele_prior = defaultdict(float)
-            for idx in alleles:
-                undivided_counts[idx] += count
-                allele = process_allele(allele_idx[idx][0], 2)
-                if population and allele in prior:
-                    allele_prior[idx] = prior[allele][population]
+        return list(columns), matrix
 
-            if population and allele_prior:
-                divide_prior(alleles, count, allele_prior)
-                continue
-
-            divide_equally(alleles, count)
-
-        return counts_to_abundances(counts), undivided_counts
+    # Divides raw counts between alleles for the first iteration
+    # of transcript quantification, equally between alleles in the same
+    # compatibility class or proportionally to allele frequency
+    def initial_abundances(alleles, active, population):
+        allele_prior = np.zeros(len(alleles))
+        if population:
+            for i, idx in enumerate(alleles):
+                allele = allele_idx.name(idx, 2)
+                if allele in prior:
+                    allele_prior[i] = prior[allele][population]
+
+        n_alleles = np.diff(matrix.indptr)[:, np.newaxis]
+        total_prob = (matrix @ allele_prior)[:, np.newaxis]
+        has_prior = total_prob > 0
+
+        divided = np.where(has_prior, 0.0, counts / n_alleles)
+        weighted = np.divide(counts, total_prob,
+                             out=np.zeros_like(counts),
+                             where=has_prior)
+
+        allele_counts = matrix_t @ divided \
+                        + allele_prior[:, np.newaxis] * (matrix_t @ weighted)
+        undivided_counts = matrix_t @ counts
+
+        return counts_to_abundances(allele_counts, active), undivided_counts
 
     # Normalizes counts by allele length and convert to abundances
-    def counts_to_abundances(counts):
-        abundances = defaultdict(float)
-
-        for allele, count in counts.items():
-            length = lengths[allele]
-            abundances[allele] = count / length
-
-        total_abundance = sum(abundances.values())
-
-        for allele, abundance in abundances.items():
-            abundances[allele] = abundance / total_abundance
-
-        return abundances
+    def counts_to_abundances(allele_counts, active):
+        abundances = np.where(active, allele_counts / allele_lengths, 0.0)
+        return abundances / abundances.sum(axis=0)
 
     # Redistribute counts between alleles in the same compatibility
-    # class based on their overall abundance
-    def update_abundances(eqs, abundances):
-        counts = defaultdict(float)
-
-        for alleles, count in eqs:
-            alleles = [allele for allele in alleles if allele in abundances]
-            total_abundance = sum([abundances[allele] for allele in alleles])
+    # class based on their overall abundance, returning the alleles
+    # still observed in a class with nonzero abundance
+    def update_abundances(abundances, active):
+        total_abundance = matrix @ abundances
+        observed = total_abundance > 0
 
-            if total_abundance == 0:
-                continue
+        weights = np.divide(counts, total_abundance,
+                            out=np.zeros_like(counts),
+                            where=observed)
+        allele_counts = abundances * (matrix_t @ weights)
 
-            for allele in alleles:
-                counts[allele] += count * (abundances[allele] / total_abundance)
+        active = active & (matrix_t @ observed.astype(float) > 0)
 
-        return counts_to_abundances(counts)
+        return counts_to_abundances(allele_counts, active), active
 
     # Drop low support alleles after a specified number of iterations if their
     # abundance is less than a specified proportion of the greatest abundance
-    def drop_alleles(eqs, abundances, drop_iterations, drop_threshold,
+    def drop_alleles(abundances, active, drop_iterations, drop_threshold,
                      iterations, converged):
         if iterations == 1:
-            abundances = {allele: abundance
-                          for allele, abundance in abundances.items()
-                          if abundance > 0.0}
-
-        elif iterations >= drop_iterations or converged:
-            threshold = drop_threshold * max(abundances.values())
-            abundances = {allele: abundance
-                          for allele, abundance in abundances.items()
-                          if abundance >= threshold}
-        return abundances, eqs
-
-    # Compute square root of sum of squares
-    def SRSS(theta):
-        square_sum = 0.0
-        for i in theta:
-            square_sum += i ** 2
-        return math.sqrt(square_sum)
-
-    # Check if sum difference between two iterations is below tolerance
-    def check_convergence(theta0, theta_prime):
-        diff = [theta_prime[allele] - theta0[allele] for allele in theta0]
-        residual_error = SRSS(diff)
-        return residual_error < tolerance
-
-    converged = False
-    iterations = 1
+            active = active & (abundances > 0.0)
 
-    theta0, undivided_counts = initial_abundances(eqs, lengths, population)
+        else:
+            threshold = drop_threshold * max_abundance(abundances, active)
+            drop = converged | (iterations >= drop_iterations)
+            active = active & (~drop | (abundances >= threshold))
 
-    log.info("[genotype] Top 10 alleles by undivided read count:")
-    log.info("\t\t{: <20}    {: >10}\t".format("allele", "read count"))
+        return np.where(active, abundances, 0.0), active
 
-    for idx, count in sorted(undivided_counts.items(),
-                             key=lambda x: x[1],
-                             reverse=True)[:10]:
-        log.info("\t\t{: <20}    {: >10.0f}\t"
-                 .format(process_allele(allele_idx[idx][0], 3), count))
+    # Removes dropped alleles from every compatibility class, merging classes
+    # left with identical alleles and discarding those left empty
+    def compact_classes(matrix, counts, keep):
+        matrix = matrix[:, keep].tocsr()
+        matrix.sort_indices()
 
-    log.info("\n[genotype] Quantifying allele transcript abundance")
+        n_alleles = np.diff(matrix.indptr)
+        rows = np.full((len(n_alleles), n_alleles.max(initial=0)), -1)
+        positions = np.arange(matrix.nnz) \
+                    - np.repeat(matrix.indptr[:-1], n_alleles)
+        rows[np.repeat(np.arange(len(n_alleles)), n_alleles),
+             positions] = matrix.indices
 
-    # SQUAREM - accelerated EM
-    # R. Varadhan & C. Roland (doi: 10.1 1 1 1/j. 1467-9469.2007.00585.X)
-    # Used by HISAT-genotype, originaly used by Sailfish
-    while iterations < max_iterations and not converged:
-        # Get next two steps
-        theta1 = update_abundances(eqs, theta0)
-        theta2 = update_abundances(eqs, theta1)
-        theta_prime = defaultdict(float)
+        rows, classes = np.unique(rows, axis=0, return_inverse=True)
+        merged = np.zeros((len(rows), counts.shape[1]))
+        np.add.at(merged, classes.ravel(), counts)
 
-        r = dict()
-        v = dict()
-        sum_r = 0.0
-        sum_v = 0.0
+        nonempty = rows[:, 0] >= 0
+        rows = rows[nonempty]
+        counts = merged[nonempty]
 
-        # Compute r and v
-        for allele in theta1:
-            r[allele] = theta1[allele] - theta0[allele]
-            v[allele] = (theta2[allele] - theta1[allele]) - r[allele]
+        observed = rows >= 0
+        indptr = np.concatenate([[0], np.cumsum(observed.sum(axis=1))])
+        matrix = sparse.csr_matrix((np.ones(indptr[-1]), rows[observed], indptr),
+                                   shape=(len(rows), keep.sum()))
 
-        srss_r = SRSS(r.values())
-        srss_v = SRSS(v.values())
+        return matrix, counts
 
-        if srss_v != 0:
-            # Compute step length
-            alpha = -(srss_r / srss_v)
-            for allele in r:
-                value = theta0[allele] \
-                        - 2 * alpha * r[allele] \
-                        + (alpha ** 2) * v[allele]
+    # Compute square root of sum of squares of each run
+    def SRSS(theta):
+        return np.sqrt((theta * theta).sum(axis=0))
 
-                theta_prime[allele] = value
+    # Returns the greatest abundance of each run among active alleles
+    def max_abundance(theta, active):
+        return np.where(active, theta, -np.inf).max(axis=0)
 
-            step_min = min(theta_prime.values())
-            step_max = max(theta_prime.values())
+    alleles, matrix = build_matrix(eqs)
+    matrix_t = matrix.T.tocsr()
+    allele_lengths = np.array([lengths[idx] for idx in alleles],
+                              dtype=float)[:, np.newaxis]
 
-            # Adjust step rather than kicking out alleles with a negative result
-            if step_min < 0:
-                theta_prime = {allele: (value - step_min) / (step_max - step_min)
-                               for allele, value in theta_prime.items()}
+    if replicate_counts is None:
+        counts = np.array([[count] for _, count in eqs], dtype=float)
+    else:
+        counts = np.array(replicate_counts, dtype=float)
+    counts = counts.reshape(len(eqs), -1)
 
-                total = sum(theta_prime.values())
+    iterations = 1
 
-                theta_prime = {allele: value / total
-                               for allele, value in theta_prime.items()}
+    active = np.ones((len(alleles), counts.shape[1]), dtype=bool)
+    theta0, undivided_counts = initial_abundances(alleles, active, population)
 
-            # Update abundances with given the new proportions
-            theta_prime = update_abundances(eqs, theta_prime)
+    log.info("[genotype] Top 10 alleles by undivided read count:")
+    log.info("\t\t{: <20}    {: >10}\t".format("allele", "read count"))
 
-        else:
-            theta_prime = theta1
+    for i in np.argsort(-undivided_counts[:, 0], kind="stable")[:10]:
+        log.info("\t\t{: <20}    {: >10.0f}\t"
+                 .format(allele_idx.name(alleles[i], 3),
+                         undivided_counts[i, 0]))
 
-        converged = check_convergence(theta0, theta_prime)
+    log.info("\n[genotype] Quantifying allele transcript abundance")
 
-        theta0, eqs = drop_alleles(eqs, theta_prime, drop_iterations,
-                                   drop_threshold, iterations, converged)
-        iterations += 1
+    # SQUAREM - accelerated EM
+    # R. Varadhan & C. Roland (doi: 10.1 1 1 1/j. 1467-9469.2007.00585.X)
+    # Used by HISAT-genotype, originaly used by Sailfish
+    # Compiled runs go through the kernel one replicate at a time, traced
+    # runs stay on the NumPy loop to record each iteration
+    if kernels.JIT and trace is None:
+        for j in range(counts.shape[1]):
+            theta0[:, j], active[:, j], run_iterations = kernels.squarem(
+                matrix.indptr, matrix.indices,
+                np.ascontiguousarray(counts[:, j]), allele_lengths[:, 0],
+                theta0[:, j].copy(), tolerance, max_iterations,
+                drop_iterations, drop_threshold)
+            iterations = max(iterations, run_iterations)
+
+    else:
+        done = np.zeros(counts.shape[1], dtype=bool)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            while iterations < max_iterations and not done.all():
+                start = time.perf_counter()
+
+                # Get next two steps
+                theta1, active1 = update_abundances(theta0, active)
+                theta2, _ = update_abundances(theta1, active1)
+
+                # Compute r and v
+                r = np.where(active1, theta1 - theta0, 0.0)
+                v = np.where(active1, (theta2 - theta1) - r, 0.0)
+
+                srss_r = SRSS(r)
+                srss_v = SRSS(v)
+                step = srss_v != 0
+
+                # Compute step length
+                alpha = -(srss_r / np.where(step, srss_v, 1.0))
+                theta_prime = np.where(active1,
+                                       theta0 - 2 * alpha * r + (alpha ** 2) * v,
+                                       0.0)
+
+                step_min = -max_abundance(-theta_prime, active1)
+                step_max = max_abundance(theta_prime, active1)
+
+                # Adjust step rather than kicking out alleles with a negative result
+                clamped = step & (step_min < 0)
+                rescaled = np.where(active1,
+                                    (theta_prime - step_min)
+                                    / (step_max - step_min),
+                                    0.0)
+                rescaled /= rescaled.sum(axis=0)
+                theta_prime = np.where(clamped, rescaled, theta_prime)
+
+                # Update abundances with given the new proportions
+                theta_prime, _ = update_abundances(theta_prime, active1)
+                theta_prime = np.where(step, theta_prime, theta1)
+
+                residual = SRSS(np.where(active, theta_prime - theta0, 0.0))
+                converged = residual < tolerance
+
+                # Runs that have converged keep their abundances
+                running = ~done
+                theta_prime, keep = drop_alleles(theta_prime, active,
+                                                 drop_iterations,
+                                                 drop_threshold, iterations,
+                                                 converged)
+                theta0 = np.where(running, theta_prime, theta0)
+                active = np.where(running, keep, active)
+                done |= converged
+
+                # Shrink the working set to the alleles surviving in any run
+                surviving = active.any(axis=1)
+                if not surviving.all():
+                    matrix, counts = compact_classes(matrix, counts,
+                                                     surviving)
+                    matrix_t = matrix.T.tocsr()
+                    alleles = [alleles[i] for i in np.flatnonzero(surviving)]
+                    allele_lengths = allele_lengths[surviving]
+                    theta0 = theta0[surviving]
+                    active = active[surviving]
+
+                if trace is not None:
+                    trace.append({"iteration": iterations,
+                                  "residual": float(residual[0]),
+                                  "alpha": float(alpha[0]) if step[0]
+                                  else None,
+                                  "clamped": bool(clamped[0]),
+                                  "alleles": int(active.sum()),
+                                  "classes": len(counts),
+                                  "seconds": time.perf_counter() - start})
+
+                iterations += 1
 
     log.info(f"[genotype] EM converged after {iterations} iterations")
 
-    return theta0
+    results = [{alleles[i]: float(theta0[i, j])
+                for i in np.flatnonzero(active[:, j])}
+               for j in range(counts.shape[1])]
+
+    return results if replicate_counts is not None else results[0]
 
 
 def predict_genotype(eqs, allele_idx, allele_eq, em_results, gene_count,
@@ -247,57 +327,51 @@ def predict_genotype(eqs, allele_idx, allele_eq, em_results, gene_count,
         observed_eqs = allele_eq[a]
         return sum([eqs[idx][1] for idx in observed_eqs])
 
-    # Returns number of reads explained by a pair of alleles
-    def get_pair_count(a1, a2):
-        if type(a1) == tuple:
-            a1_eqs = set.union(*[allele_eq[idx] for idx in a1])
+    # Returns reads explained by each pair of allele groups and, for each
+    # pair, reads explained by the first group but not the second, from the
+    # count-weighted overlap of the groups' compatibility classes
+    def score_pairs(groups):
+        membership = np.zeros((len(groups), len(eqs)))
+        for i, group in enumerate(groups):
+            for idx in group:
+                membership[i, list(allele_eq[idx])] = 1.0
+
+        counts = np.array([count for _, count in eqs], dtype=float)
+        if kernels.JIT:
+            shared = kernels.shared_counts(membership, counts)
         else:
-            a1_eqs = allele_eq[a1]
-        if type(a2) == tuple:
-            a2_eqs = set.union(*[allele_eq[idx] for idx in a2])
-        else:
-            a2_eqs = allele_eq[a2]
+            shared = (membership * counts) @ membership.T
+        single = np.diag(shared)
 
-        observed_eqs = a1_eqs | a2_eqs
+        pair_counts = single[:, np.newaxis] + single[np.newaxis, :] - shared
+        nonshared_counts = single[:, np.newaxis] - shared
 
-        return sum([eqs[idx][1] for idx in observed_eqs])
+        return pair_counts, nonshared_counts
 
-    # Returns non-shared counts for a pair of alleles
-    def get_nonshared_count(a1, a2):
-        if type(a1) == tuple:
-            a1_eqs = set.union(*[allele_eq[idx] for idx in a1])
-        else:
-            a1_eqs = allele_eq[a1]
-        if type(a2) == tuple:
-            a2_eqs = set.union(*[allele_eq[idx] for idx in a2])
-        else:
-            a2_eqs = allele_eq[a2]
-
-        a1_nonshared_eqs = a1_eqs - a2_eqs
-        a2_nonshared_eqs = a2_eqs - a1_eqs
-
-        a1_count = sum([eqs[idx][1] for idx in a1_nonshared_eqs])
-        a2_count = sum([eqs[idx][1] for idx in a2_nonshared_eqs])
-
-        return a1_count, a2_count
+    # Orders reference indices by their decimal names, which decides the
+    # allele reported for a group of indices
+    def by_name(indices):
+        return sorted(indices, key=str)
 
     explained_reads = dict()
     if len(em_results) > 1:
         grouped_indices = defaultdict(set)
         for idx, alleles, abundances in em_results:
-            allele = process_allele(alleles[0], 2)
+            allele = allele_idx.name(idx, 2)
             grouped_indices[allele].add(idx)
 
-        grouped_indices = [tuple(v) for v in grouped_indices.values()]
+        grouped_indices = [tuple(by_name(v)) for v in grouped_indices.values()]
 
-        if len(grouped_indices) > 1:
-            for a1, a2 in combinations(grouped_indices, 2):
-                pair_count = get_pair_count(a1, a2)
-                explained_reads[(a1, a2)] = pair_count / gene_count
-        else:
-            a1, a2 = sorted(list(grouped_indices)[0])[:2]
-            pair_count = get_pair_count(a1, a2)
-            explained_reads[((a1,), (a2,))] = pair_count / gene_count
+        if len(grouped_indices) == 1:
+            a1, a2 = by_name(grouped_indices[0])[:2]
+            grouped_indices = [(a1,), (a2,)]
+
+        pair_counts, nonshared_counts = score_pairs(grouped_indices)
+        group_position = {group: i for i, group in enumerate(grouped_indices)}
+
+        for i, j in zip(*np.triu_indices(len(grouped_indices), 1)):
+            pair = (grouped_indices[i], grouped_indices[j])
+            explained_reads[pair] = pair_counts[i, j] / gene_count
 
         # Print information
         log.info("\n[genotype] Pairs by % explained reads:")
@@ -305,8 +379,8 @@ def predict_genotype(eqs, allele_idx, allele_eq, em_results, gene_count,
         for (a1, a2), count in sorted(explained_reads.items(),
                                       key=lambda x: x[1],
                                       reverse=True):
-            alleles = ", ".join([process_allele(allele_idx[a1[0]][0], 3),
-                                 process_allele(allele_idx[a2[0]][0], 3)])
+            alleles = ", ".join([allele_idx.name(a1[0], 3),
+                                 allele_idx.name(a2[0], 3)])
             log.info("\t\t{: <28}    {: >9.2f}%\t"
                      .format(alleles, count * 100))
 
@@ -320,8 +394,8 @@ def predict_genotype(eqs, allele_idx, allele_eq, em_results, gene_count,
 
         if len(top_by_reads) > 1 and population:
             for a1, a2 in top_by_reads.keys():
-                allele1 = process_allele(allele_idx[a1[0]][0], 2)
-                allele2 = process_allele(allele_idx[a2[0]][0], 2)
+                allele1 = allele_idx.name(a1[0], 2)
+                allele2 = allele_idx.name(a2[0], 2)
                 if allele1 not in prior or allele2 not in prior:
                     continue
 
@@ -333,18 +407,21 @@ def predict_genotype(eqs, allele_idx, allele_eq, em_results, gene_count,
             pair_prior = {pair: prior for pair, prior in pair_prior.items()
                           if prior >= max_prior}
 
-            a1, a2 = sorted(pair_prior.keys(), key=lambda x: (x[0], x[1]))[0]
+            a1, a2 = sorted(pair_prior.keys(),
+                            key=lambda x: (list(map(str, x[0])),
+                                           list(map(str, x[1]))))[0]
 
         else:
             a1, a2 = sorted(top_by_reads.items(),
                             key=lambda x: x[1],
                             reverse=True)[0][0]
 
-        pair_count = get_pair_count(a1, a2)
-        a1_count, a2_count = get_nonshared_count(a1, a2)
+        i, j = group_position[a1], group_position[a2]
+        pair_count = pair_counts[i, j]
+        a1_count, a2_count = nonshared_counts[i, j], nonshared_counts[j, i]
 
-        a1 = process_allele(allele_idx[sorted(a1)[0]][0], 3)
-        a2 = process_allele(allele_idx[sorted(a2)[0]][0], 3)
+        a1 = allele_idx.name(by_name(a1)[0], 3)
+        a2 = allele_idx.name(by_name(a2)[0], 3)
         # Zygosity check based on nonshared counts
         log.info("\n[genotype] Checking zygosity")
         if a1_count == a2_count == 0:
@@ -380,23 +457,20 @@ def predict_genotype(eqs, allele_idx, allele_eq, em_results, gene_count,
         pair_count = get_count(a1)
         a1_count = pair_count
         a2_count = None
-        genotype = [process_allele(alleles[0], 3), process_allele(alleles[0], 3)]
+        genotype = [allele_idx.name(a1, 3), allele_idx.name(a1, 3)]
 
     return genotype, pair_count
 
 
-def genotype_gene(gene, gene_count, eqs, lengths, allele_idx, population,
-                  prior, tolerance, max_iterations, drop_iterations,
-                  drop_threshold, zygosity_threshold):
+def genotype_gene(gene, gene_count, eqs, allele_eq, lengths, allele_idx,
+                  population, prior, tolerance, max_iterations,
+                  drop_iterations, drop_threshold, zygosity_threshold,
+                  trace=None):
     """Calls transcript quantification and genotype prediction."""
 
-    if gene not in {"A", "B", "C", "DRB1", "DQB1", "DQA1"}:
+    if gene not in prior_genes:
         population = None
 
-    allele_idx = json.loads(allele_idx)
-    lengths = json.loads(lengths)
-    lengths = dict([a, int(x)] for a, x in lengths.items())
-
     em_results = expectation_maximization(eqs,
                                           lengths,
                                           allele_idx,
@@ -405,18 +479,19 @@ def genotype_gene(gene, gene_count, eqs, lengths, allele_idx, population,
                                           tolerance,
                                           max_iterations,
                                           drop_iterations,
-                                          drop_threshold)
+                                          drop_threshold,
+                                          trace)
 
     em_results = [[idx, allele_idx[idx], a] for idx, a in em_results.items()]
 
     log.info("\n[genotype] Top alleles by abundance:")
     log.info("\t\t{: <20}    {: >9}".format("allele", "abundance"))
 
-    for _, alleles, abundance in sorted(em_results,
-                                        key=lambda x: x[2],
-                                        reverse=True):
+    for idx, _, abundance in sorted(em_results,
+                                    key=lambda x: x[2],
+                                    reverse=True):
         log.info("\t\t{: <20}    {: >8.2f}%"
-                 .format(process_allele(alleles[0], 3), abundance * 100))
+                 .format(allele_idx.name(idx, 3), abundance * 100))
 
     genotype, pair_count = predict_genotype(eqs,
                                             allele_idx,
@@ -436,6 +511,385 @@ def genotype_gene(gene, gene_count, eqs, lengths, allele_idx, population,
     return em_results, genotype
 
 
+# -----------------------------------------------------------------------------
+# Bootstraps genotype calls
+# -----------------------------------------------------------------------------
+
+def bootstrap_gene(gene, eqs, allele_eq, lengths, allele_idx, population,
+                   prior, tolerance, max_iterations, drop_iterations,
+                   drop_threshold, zygosity_threshold, genotype, replicates,
+                   seed):
+    """Resamples compatibility class counts and genotypes each replicate,
+       returning the proportion of replicates supporting each allele and
+       each pair of alleles.
+    """
+    if gene not in prior_genes:
+        population = None
+
+    counts = np.array([count for _, count in eqs], dtype=float)
+    gene_count = counts.sum()
+
+    rng = np.random.default_rng([seed, *gene.encode()])
+    replicate_counts = rng.multinomial(round(gene_count), counts / gene_count,
+                                       size=replicates).T.astype(float)
+
+    # Discards the EM log of the replicates
+    with capture_log():
+        replicate_results = expectation_maximization(eqs,
+                                                     lengths,
+                                                     allele_idx,
+                                                     population,
+                                                     prior,
+                                                     tolerance,
+                                                     max_iterations,
+                                                     drop_iterations,
+                                                     drop_threshold,
+                                                     replicate_counts=
+                                                     replicate_counts)
+
+    class_indices = [indices for indices, _ in eqs]
+    allele_support = defaultdict(int)
+    pair_support = defaultdict(int)
+    for j, em_results in enumerate(replicate_results):
+        replicate_eqs = list(zip(class_indices,
+                                 replicate_counts[:, j].tolist()))
+        em_results = [[idx, allele_idx[idx], a] for idx, a in em_results.items()]
+
+        # Discards the scoring log of each replicate
+        with capture_log():
+            replicate_genotype, _ = predict_genotype(replicate_eqs,
+                                                     allele_idx,
+                                                     allele_eq,
+                                                     em_results,
+                                                     replicate_counts[:, j].sum(),
+                                                     population,
+                                                     prior,
+                                                     zygosity_threshold)
+
+        for allele in set(replicate_genotype):
+            allele_support[allele] += 1
+        pair_support[",".join(sorted(replicate_genotype))] += 1
+
+    support = {"replicates": replicates,
+               "genotype": genotype,
+               "alleles": {allele: count / replicates for allele, count
+                           in sorted(allele_support.items(),
+                                     key=lambda x: x[1], reverse=True)},
+               "pairs": {pair: count / replicates for pair, count
+                         in sorted(pair_support.items(),
+                                   key=lambda x: x[1], reverse=True)}}
+
+    log.info(f"\n[genotype] Bootstrap support over {replicates} replicates:")
+    for allele in genotype:
+        log.info("\t\t{: <20}    {: >8.2f}%"
+                 .format(allele, support["alleles"].get(allele, 0) * 100))
+    log.info("\t\t{: <20}    {: >8.2f}%"
+             .format("genotype",
+                     support["pairs"].get(",".join(sorted(genotype)), 0) * 100))
+
+    return support
+
+
+# -----------------------------------------------------------------------------
+# Genotypes loci in parallel
+# -----------------------------------------------------------------------------
+
+# Reference tables shared by all loci genotyped in a worker process
+worker_reference = dict()
+
+
+def init_worker(lengths, allele_idx, prior):
+    """Stores reference tables once per worker process."""
+    worker_reference.update(lengths=lengths, allele_idx=allele_idx,
+                            prior=prior)
+
+
+def genotype_gene_worker(gene, gene_count, eqs, allele_eq, population,
+                         tolerance, max_iterations, drop_iterations,
+                         drop_threshold, zygosity_threshold, trace,
+                         bootstrap, seed):
+    """Genotypes a locus, returning its log messages and, if traced, its
+       EM iterations and, if bootstrapped, its support with the results.
+    """
+    gene_trace = [] if trace else None
+    support = None
+    with capture_log() as messages:
+        em, genotype = genotype_gene(gene,
+                                     gene_count,
+                                     eqs,
+                                     allele_eq,
+                                     worker_reference["lengths"],
+                                     worker_reference["allele_idx"],
+                                     population,
+                                     worker_reference["prior"],
+                                     tolerance, max_iterations,
+                                     drop_iterations, drop_threshold,
+                                     zygosity_threshold, gene_trace)
+
+        if bootstrap:
+            support = bootstrap_gene(gene, eqs, allele_eq,
+                                     worker_reference["lengths"],
+                                     worker_reference["allele_idx"],
+                                     population,
+                                     worker_reference["prior"],
+                                     tolerance, max_iterations,
+                                     drop_iterations, drop_threshold,
+                                     zygosity_threshold, genotype,
+                                     bootstrap, seed)
+
+    return em, genotype, messages, gene_trace, support
+
+
+def genotype_genes(genes, eq_idx, allele_eq, gene_stats, lengths, allele_idx,
+                   population, prior, tolerance, max_iterations,
+                   drop_iterations, drop_threshold, zygosity_threshold,
+                   min_count, threads, traces=None, bootstrap=0, seed=0,
+                   supports=None):
+    """Genotypes each locus on a pool of worker processes, writing each
+       locus' log output in gene order. If a traces dict is given, stores
+       the EM iterations of each locus. If bootstrap replicates are
+       requested, stores the support of each locus in the supports dict.
+    """
+    jobs = dict()
+    for gene in genes:
+        if gene not in gene_stats or gene_stats[gene][0] < min_count:
+            continue
+
+        eqs = eq_idx[gene]
+        gene_allele_eq = {idx: allele_eq[idx] for indices, _ in eqs
+                          for idx in indices}
+        jobs[gene] = (gene, gene_stats[gene][0], eqs, gene_allele_eq,
+                      population, tolerance, max_iterations,
+                      drop_iterations, drop_threshold, zygosity_threshold,
+                      traces is not None, bootstrap, seed)
+
+    workers = min(threads, len(jobs))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker,
+                                 initargs=(lengths, allele_idx, prior)) as pool:
+            results = list(pool.map(genotype_gene_worker,
+                                    *zip(*jobs.values())))
+    else:
+        init_worker(lengths, allele_idx, prior)
+        results = [genotype_gene_worker(*job) for job in jobs.values()]
+    results = dict(zip(jobs, results))
+
+    em_results = dict()
+    genotypes = dict()
+
+    for gene in genes:
+        hline()
+        log.info(f"[genotype] Genotyping HLA-{gene}")
+
+        # Skips loci with not enough reads to genotype
+        if gene not in jobs:
+            log.info(f"[genotype] Not enough reads aligned to HLA-{gene} to genotype.")
+            continue
+        gene_count, eq_count, abundance = gene_stats[gene]
+        log.info(f"[genotype] {gene_count:.0f} reads aligned to HLA-{gene} " +
+                 f"in {eq_count} classes")
+
+        (em_results[gene], genotypes[gene],
+         messages, gene_trace, support) = results[gene]
+        if traces is not None:
+            traces[gene] = gene_trace
+        if supports is not None:
+            supports[gene] = support
+        for message in messages:
+            log.info(message)
+
+    return em_results, genotypes
+
+
+def genotype_alignment(alignment_info, sample, outdir, genes, lengths,
+                       allele_idx, population, prior, tolerance,
+                       max_iterations, drop_iterations, drop_threshold,
+                       zygosity_threshold, min_count, threads, trace,
+                       bootstrap, seed):
+    """Genotypes a sample from its pseudoalignment, writing its
+       genotype.json and, if requested, genotype.trace.json and
+       genotype.bootstrap.json.
+    """
+    (commithash, eq_idx, allele_eq,
+     paired, align_stats, gene_stats) = alignment_info
+
+    # Set up EM parameters
+    if not drop_iterations:
+        if paired:
+            drop_iterations = 20
+        else:
+            drop_iterations = 4
+
+    hline()
+    log.info("[genotype] Genotyping parameters:")
+    log.info("\t\tpopulation: %s", population)
+    log.info("\t\tminimum count: %s", min_count)
+    log.info("\t\tmax iterations: %s", max_iterations)
+    log.info("\t\ttolerance: %s", tolerance)
+    log.info("\t\tdrop iterations: %s", drop_iterations)
+    log.info("\t\tdrop threshold: %s", drop_threshold)
+    log.info("\t\tzygosity threshold: %s", zygosity_threshold)
+
+    # For each HLA locus, perform EM then scoring
+    traces = dict() if trace else None
+    supports = dict() if bootstrap else None
+    em_results, genotypes = genotype_genes(genes,
+                                           eq_idx,
+                                           allele_eq,
+                                           gene_stats,
+                                           lengths,
+                                           allele_idx,
+                                           population, prior,
+                                           tolerance,
+                                           max_iterations,
+                                           drop_iterations,
+                                           drop_threshold,
+                                           zygosity_threshold,
+                                           min_count,
+                                           threads,
+                                           traces,
+                                           bootstrap,
+                                           seed,
+                                           supports)
+
+    with open("".join([outdir, sample, ".genotype.json"]), "w") as file:
+        json.dump(genotypes, file)
+
+    if trace:
+        parameters = {"population": population,
+                      "tolerance": tolerance,
+                      "max_iterations": max_iterations,
+                      "drop_iterations": drop_iterations,
+                      "drop_threshold": drop_threshold}
+        with open("".join([outdir, sample, ".genotype.trace.json"]), "w") as file:
+            json.dump({"sample": sample,
+                       "parameters": parameters,
+                       "genes": traces}, file)
+
+    if bootstrap:
+        with open("".join([outdir, sample, ".genotype.bootstrap.json"]), "w") as file:
+            json.dump(supports, file)
+
+    return genotypes
+
+
+# -----------------------------------------------------------------------------
+# Genotypes samples in batch
+# -----------------------------------------------------------------------------
+
+def get_batch_files(batch):
+    """Lists alignment files in a directory or in a manifest with one
+       file per line.
+    """
+    if os.path.isdir(batch):
+        return sorted(os.path.join(batch, file) for file in os.listdir(batch)
+                      if file.endswith(".alignment.p"))
+
+    with open(batch, "r") as file:
+        return [line.strip() for line in file
+                if line.strip() and not line.startswith("#")]
+
+
+def check_batch_samples(files):
+    """Exits if files in a batch share a sample name, since their outputs
+       would overwrite each other.
+    """
+    samples = defaultdict(list)
+    for file in files:
+        samples[os.path.basename(file).split(".")[0]].append(file)
+
+    duplicates = [", ".join(files) for files in samples.values()
+                  if len(files) > 1]
+    if duplicates:
+        sys.exit("[genotype] Error: files in batch with the same sample " +
+                 "name:\n\t" + "\n\t".join(duplicates))
+
+
+def genotype_sample_worker(file, commithash, outdir, genes, population,
+                           tolerance, max_iterations, drop_iterations,
+                           drop_threshold, zygosity_threshold, min_count,
+                           trace, bootstrap, seed):
+    """Genotypes a sample from a previous alignment, writing the usual
+       genotype.json and genotype.log. Returns the sample name and an
+       error message if it could not be genotyped, so that a missing,
+       corrupted or incompatible file does not stop the batch.
+    """
+    sample = os.path.basename(file).split(".")[0]
+    error = None
+    messages = []
+
+    try:
+        with capture_log() as messages:
+            log.info("")
+            hline()
+            log.info("[log] Date: %s", str(date.today()))
+            log.info("[log] Sample: %s", sample)
+            log.info("[log] Input file(s): %s", file)
+            log.info("[log] Reference: %s", commithash)
+            hline()
+
+            try:
+                alignment_info = load_alignment(file, commithash, genes=genes)
+                genotype_alignment(alignment_info, sample, outdir, genes,
+                                   worker_reference["lengths"],
+                                   worker_reference["allele_idx"],
+                                   population, worker_reference["prior"],
+                                   tolerance, max_iterations,
+                                   drop_iterations, drop_threshold,
+                                   zygosity_threshold, min_count, 1, trace,
+                                   bootstrap, seed)
+            except (Exception, SystemExit) as exception:
+                error = str(exception) or type(exception).__name__
+                log.info(f"[genotype] Error: {error}")
+
+            hline()
+            log.info("")
+
+    finally:
+        with open("".join([outdir, sample, ".genotype.log"]), "w") as log_file:
+            log_file.write("\n".join(messages) + "\n")
+
+    return sample, error
+
+
+def genotype_batch(files, commithash, outdir, genes, lengths, allele_idx,
+                   population, prior, tolerance, max_iterations,
+                   drop_iterations, drop_threshold, zygosity_threshold,
+                   min_count, threads, trace, bootstrap, seed):
+    """Genotypes samples from previous alignments on a pool of worker
+       processes that load the reference and priors once.
+    """
+    jobs = [(file, commithash, outdir, genes, population, tolerance,
+             max_iterations, drop_iterations, drop_threshold,
+             zygosity_threshold, min_count, trace, bootstrap, seed)
+            for file in files]
+
+    workers = min(threads, len(jobs))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker,
+                                 initargs=(lengths, allele_idx, prior)) as pool:
+            results = pool.map(genotype_sample_worker, *zip(*jobs))
+            results = list(results)
+    else:
+        init_worker(lengths, allele_idx, prior)
+        results = [genotype_sample_worker(*job) for job in jobs]
+
+    failed = 0
+    for sample, error in results:
+        if error:
+            failed += 1
+            log.info(f"[genotype] Failed to genotype {sample}: {error}")
+        else:
+            log.info(f"[genotype] Genotyped {sample}")
+
+    log.info(f"[genotype] Genotyped {len(results) - failed} of " +
+             f"{len(results)} samples")
+
+    return results
+
+
 # -----------------------------------------------------------------------------
 # Runs genotyping
 # -----------------------------------------------------------------------------
@@ -487,6 +941,16 @@ def arg_check_iterations(parser, arg):
         parser.error("The number of iterations must be an integer.")
 
 
+def arg_check_reads(parser, arg):
+    try:
+        value = int(arg)
+    except ValueError:
+        parser.error("The number of reads must be an integer.")
+    if value < 0:
+        parser.error("The number of reads must be positive.")
+    return value
+
+
 def arg_check_threshold(parser, arg):
     try:
         value = float(arg)
@@ -617,9 +1081,40 @@ if __name__ == "__main__":
                         help="keep intermediate files\n\n",
                         default=False)
 
+    parser.add_argument("--batch",
+                        type=str,
+                        help="directory or manifest (one path per line) of " +
+                             "alignment.p files to genotype\n  " +
+                             "in a single run, writing each sample's " +
+                             "genotype.json and log to outdir\n\n",
+                        default=None,
+                        metavar="")
+
+    parser.add_argument("--bootstrap",
+                        type=lambda x: arg_check_iterations(parser, x),
+                        help="number of bootstrap replicates of class counts " +
+                             "used to report\n  support for each call in " +
+                             "sample.genotype.bootstrap.json\n  default: 0\n\n",
+                        default=0,
+                        metavar="")
+
+    parser.add_argument("--seed",
+                        type=int,
+                        help="random seed\n  default: 0\n\n",
+                        default=0,
+                        metavar="")
+
+    parser.add_argument("--trace",
+                        action="store_true",
+                        help="write per-iteration EM statistics for each " +
+                             "gene to sample.genotype.trace.json\n\n",
+                        default=False)
+
     parser.add_argument("-t",
                         "--threads",
                         type=str,
+                        help="number of threads for pseudoalignment and " +
+                             "parallel genotyping of loci\n  default: 1\n\n",
                         default="1",
                         metavar="")
 
@@ -642,6 +1137,36 @@ if __name__ == "__main__":
                              "for single-end reads\n  default: 20\n\n",
                         default=20)
 
+    parser.add_argument("--count_reads",
+                        action="store_true",
+                        help="count FASTQ records in a separate pass and " +
+                             "check them against Kallisto's total\n\n",
+                        default=False)
+
+    parser.add_argument("--max_reads",
+                        type=lambda x: arg_check_reads(parser, x),
+                        help="reservoir sample at most this many reads, or " +
+                             "read pairs if paired-end,\n  before " +
+                             "pseudoalignment, 0 to align all reads\n  " +
+                             "default: 0\n\n",
+                        default=0,
+                        metavar="")
+
+    parser.add_argument("--collapse",
+                        action="store_true",
+                        help="pseudoalign identical reads or read pairs " +
+                             "once, scaling their class counts\n  " +
+                             "by their multiplicity\n\n",
+                        default=False)
+
+    parser.add_argument("--partial",
+                        action="store_true",
+                        help="also pseudoalign reads against the partial " +
+                             "allele reference in the same pass,\n  " +
+                             "writing sample.partial_alignment.p for " +
+                             "arcasHLA partial\n\n",
+                        default=False)
+
     parser.add_argument("--single",
                         action="store_true",
                         help="Include flag if single-end reads. Default is paired-end.\n\n",
@@ -649,11 +1174,26 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    if len(args.file) == 0:
+    if args.batch:
+        if args.file:
+            sys.exit("[genotype] Error: --batch does not take FASTQ or " +
+                     "alignment.p files.")
+        if not os.path.exists(args.batch):
+            sys.exit("[genotype] Error: batch %s does not exist." % args.batch)
+        batch_files = get_batch_files(args.batch)
+        if not batch_files:
+            sys.exit("[genotype] Error: no alignment.p files in %s." % args.batch)
+        check_batch_samples(batch_files)
+        sample = "batch"
+        args.file = [args.batch]
+
+    elif len(args.file) == 0:
         sys.exit("[genotype] Error: FASTQ or alignment.p file required.")
 
+    else:
+        sample = os.path.basename(args.file[0]).split(".")[0]
+
     # Set up temporary and output folders, log file
-    sample = os.path.basename(args.file[0]).split(".")[0]
     outdir = check_path(args.outdir)
     temp = create_temp(args.temp)
     if args.log:
@@ -690,77 +1230,49 @@ if __name__ == "__main__":
     check_ref()
 
     # Loads reference information
-    # with open(hla_p, 'rb') as file:
-    #    reference_info = pickle.load(file)
-    #    (commithash,(gene_set, allele_idx,
-    #     lengths, gene_length)) = reference_info
-    with open(hla_json, "r") as file:
-        reference_info = json.load(file)
-        (commithash, (gene_set, allele_idx,
-                      lengths, gene_length)) = reference_info
+    reference = load_reference(hla_json)
+    commithash = reference.commithash
+    allele_idx = reference.allele_idx
+    lengths = reference.lengths
 
     log.info("[log] Reference: %s", commithash)
     hline()
 
-    if args.file[0].endswith(".alignment.p"):
-        alignment_info = load_alignment(args.file[0], commithash)
-    else:
-        alignment_info = get_alignment(args.file, sample, hla_idx,
-                                       reference_info, outdir, temp,
-                                       args.threads, args.single,
-                                       avg=args.avg, std=args.std)
-
-    (commithash, eq_idx, allele_eq,
-     paired, align_stats, gene_stats) = alignment_info
+    if args.batch:
+        genotype_batch(batch_files, commithash, outdir, args.genes, lengths,
+                       allele_idx, args.population, prior, args.tolerance,
+                       args.max_iterations, args.drop_iterations,
+                       args.drop_threshold, args.zygosity_threshold,
+                       args.min_count, int(args.threads), args.trace,
+                       args.bootstrap, args.seed)
 
-    # Set up EM parameters
-    if not args.drop_iterations:
-        if paired:
-            args.drop_iterations = 20
+    else:
+        if args.file[0].endswith(".alignment.p"):
+            alignment_info = load_alignment(args.file[0], commithash,
+                                            genes=args.genes)
         else:
-            args.drop_iterations = 4
-
-    em_results = dict()
-    genotypes = dict()
-
-    hline()
-    log.info("[genotype] Genotyping parameters:")
-    log.info("\t\tpopulation: %s", args.population)
-    log.info("\t\tminimum count: %s", args.min_count)
-    log.info("\t\tmax iterations: %s", args.max_iterations)
-    log.info("\t\ttolerance: %s", args.tolerance)
-    log.info("\t\tdrop iterations: %s", args.drop_iterations)
-    log.info("\t\tdrop threshold: %s", args.drop_threshold)
-    log.info("\t\tzygosity threshold: %s", args.zygosity_threshold)
-
-    # For each HLA locus, perform EM then scoring
-    for gene in args.genes:
-        hline()
-        log.info(f"[genotype] Genotyping HLA-{gene}")
-
-        # Skips loci with not enough reads to genotype
-        if gene not in gene_stats or gene_stats[gene][0] < args.min_count:
-            log.info(f"[genotype] Not enough reads aligned to HLA-{gene} to genotype.")
-            continue
-        gene_count, eq_count, abundance = gene_stats[gene]
-        log.info(f"[genotype] {gene_count:.0f} reads aligned to HLA-{gene} " +
-                 f"in {eq_count} classes")
-
-        em, genotype = genotype_gene(gene,
-                                     gene_count,
-                                     eq_idx[gene],
-                                     lengths,
-                                     allele_idx,
-                                     args.population, prior,
-                                     args.tolerance, args.max_iterations,
-                                     args.drop_iterations, args.drop_threshold,
-                                     args.zygosity_threshold)
-
-        em_results[gene] = em
-        genotypes[gene] = genotype
-
-    with open("".join([outdir, sample, ".genotype.json"]), "w") as file:
-        json.dump(genotypes, file)
+            # Partial typing alignment from the same pass over the reads
+            partial_index, partial_reference = None, None
+            if args.partial:
+                partial_index = partial_idx
+                partial_reference = load_reference(partial_json)
+
+            alignment_info = get_alignment(args.file, sample, hla_idx,
+                                           reference, outdir, temp,
+                                           args.threads, args.single,
+                                           args.avg, args.std,
+                                           args.count_reads,
+                                           partial_index, partial_reference,
+                                           args.collapse, args.max_reads,
+                                           args.seed)
+
+        genotype_alignment(alignment_info, sample, outdir, args.genes,
+                           lengths, allele_idx, args.population, prior,
+                           args.tolerance, args.max_iterations,
+                           args.drop_iterations, args.drop_threshold,
+                           args.zygosity_threshold, args.min_count,
+                           int(args.threads), args.trace,
+                           args.bootstrap, args.seed)
 
     remove_files(temp, args.keep_files)
 
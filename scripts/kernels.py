@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+#   kernels.py: compiled EM and scoring kernels, used when numba is installed.
+# -------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------
+#   This file is part of arcasHLA.
+#
+#   arcasHLA is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   arcasHLA is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with arcasHLA.  If not, see <https://www.gnu.org/licenses/>.
+# -------------------------------------------------------------------------------
+
+import math
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# -------------------------------------------------------------------------------
+
+__version__ = "0.4.0"
+__date__ = "2022-01-27"
+
+# -------------------------------------------------------------------------------
+
+# Compiled kernels are used whenever numba is available, genotype.py falls
+# back to its NumPy implementation otherwise
+JIT = numba is not None
+
+
+def jit(function):
+    """Compiles a kernel with numba, if installed."""
+    if not JIT:
+        return function
+    return numba.njit(cache=True, nogil=True)(function)
+
+
+# -------------------------------------------------------------------------------
+#   Expectation maximization
+# -------------------------------------------------------------------------------
+
+@jit
+def update_abundances(indptr, indices, counts, lengths, abundances, active):
+    """Redistributes class counts between alleles by abundance, returning
+       normalized abundances and the alleles still observed.
+    """
+    allele_counts = np.zeros(len(abundances))
+    observed = np.zeros(len(abundances), dtype=np.bool_)
+
+    for row in range(len(counts)):
+        total_abundance = 0.0
+        for k in range(indptr[row], indptr[row + 1]):
+            total_abundance += abundances[indices[k]]
+
+        if total_abundance > 0:
+            weight = counts[row] / total_abundance
+            for k in range(indptr[row], indptr[row + 1]):
+                allele_counts[indices[k]] += weight
+                observed[indices[k]] = True
+
+    active = active & observed
+    abundances = np.where(active, abundances * allele_counts / lengths, 0.0)
+
+    return abundances / abundances.sum(), active
+
+
+@jit
+def same_alleles(indptr, indices, row, other):
+    """Checks if two classes with sorted alleles have the same alleles."""
+    if indptr[row + 1] - indptr[row] != indptr[other + 1] - indptr[other]:
+        return False
+    for k in range(indptr[row + 1] - indptr[row]):
+        if indices[indptr[row] + k] != indices[indptr[other] + k]:
+            return False
+    return True
+
+
+@jit
+def compact_classes(indptr, indices, counts, keep):
+    """Removes dropped alleles from every compatibility class, merging classes
+       left with identical alleles and discarding those left empty. Merged
+       classes take the place of the first of them.
+    """
+    stripped_indptr = np.zeros(len(indptr), dtype=indptr.dtype)
+    stripped_indices = np.empty(len(indices), dtype=indices.dtype)
+    hashes = np.zeros(len(counts), dtype=np.int64)
+
+    nnz = 0
+    for row in range(len(counts)):
+        start = nnz
+        for k in range(indptr[row], indptr[row + 1]):
+            if keep[indices[k]]:
+                stripped_indices[nnz] = indices[k]
+                nnz += 1
+        stripped_indices[start:nnz] = np.sort(stripped_indices[start:nnz])
+        stripped_indptr[row + 1] = nnz
+
+        # Hashes the sorted alleles, keeping 63 bits so hashes are the same
+        # whether or not the kernel is compiled
+        h = nnz - start
+        for k in range(start, nnz):
+            h = (h * 1000003 + stripped_indices[k] + 1) & 0x7FFFFFFFFFFFFFFF
+        hashes[row] = h
+
+    # Points every class at the first class with the same alleles, only
+    # comparing classes with equal hashes
+    first = np.full(len(counts), -1, dtype=np.int64)
+    order = np.argsort(hashes, kind="mergesort")
+    i = 0
+    while i < len(order):
+        j = i
+        while j < len(order) and hashes[order[j]] == hashes[order[i]]:
+            j += 1
+        for a in range(i, j):
+            if first[order[a]] >= 0:
+                continue
+            first[order[a]] = order[a]
+            for b in range(a + 1, j):
+                if first[order[b]] < 0 and same_alleles(
+                        stripped_indptr, stripped_indices, order[a],
+                        order[b]):
+                    first[order[b]] = order[a]
+        i = j
+
+    new_indptr = np.zeros(len(indptr), dtype=indptr.dtype)
+    new_indices = np.empty(nnz, dtype=indices.dtype)
+    new_counts = np.zeros(len(counts))
+    new_row = np.full(len(counts), -1, dtype=np.int64)
+
+    rows = 0
+    nnz = 0
+    for row in range(len(counts)):
+        if stripped_indptr[row + 1] == stripped_indptr[row]:
+            continue
+        if first[row] == row:
+            for k in range(stripped_indptr[row], stripped_indptr[row + 1]):
+                new_indices[nnz] = stripped_indices[k]
+                nnz += 1
+            new_row[row] = rows
+            rows += 1
+            new_indptr[rows] = nnz
+        new_counts[new_row[first[row]]] += counts[row]
+
+    return new_indptr[:rows + 1], new_indices[:nnz], new_counts[:rows]
+
+
+@jit
+def squarem(indptr, indices, counts, lengths, theta0, tolerance,
+            max_iterations, drop_iterations, drop_threshold):
+    """SQUAREM over a CSR class by allele matrix, mirroring the NumPy loop in
+       genotype.expectation_maximization. Returns abundances, the mask of
+       alleles kept and the iteration count.
+    """
+    active = np.ones(len(theta0), dtype=np.bool_)
+    converged = False
+    iterations = 1
+
+    while iterations < max_iterations and not converged:
+        theta1, active1 = update_abundances(indptr, indices, counts, lengths,
+                                            theta0, active)
+        theta2, _ = update_abundances(indptr, indices, counts, lengths,
+                                      theta1, active1)
+
+        r = np.where(active1, theta1 - theta0, 0.0)
+        v = np.where(active1, (theta2 - theta1) - r, 0.0)
+
+        srss_r = math.sqrt(np.dot(r, r))
+        srss_v = math.sqrt(np.dot(v, v))
+
+        if srss_v != 0:
+            alpha = -(srss_r / srss_v)
+            theta_prime = np.where(active1,
+                                   theta0 - 2 * alpha * r + (alpha ** 2) * v,
+                                   0.0)
+
+            step_min = theta_prime[active1].min()
+            step_max = theta_prime[active1].max()
+
+            if step_min < 0:
+                theta_prime = np.where(active1,
+                                       (theta_prime - step_min)
+                                       / (step_max - step_min),
+                                       0.0)
+                theta_prime /= theta_prime.sum()
+
+            theta_prime, _ = update_abundances(indptr, indices, counts,
+                                               lengths, theta_prime, active1)
+        else:
+            theta_prime = theta1
+
+        residual = (theta_prime - theta0)[active]
+        converged = math.sqrt(np.dot(residual, residual)) < tolerance
+
+        if iterations == 1:
+            keep = active & (theta_prime > 0.0)
+        elif iterations >= drop_iterations or converged:
+            threshold = drop_threshold * theta_prime[active].max()
+            keep = active & (theta_prime >= threshold)
+        else:
+            keep = active
+
+        theta0 = np.where(keep, theta_prime, 0.0)
+
+        if keep.sum() < active.sum():
+            indptr, indices, counts = compact_classes(indptr, indices,
+                                                      counts, keep)
+        active = keep
+
+        iterations += 1
+
+    return theta0, active, iterations
+
+
+# -------------------------------------------------------------------------------
+#   Genotype scoring
+# -------------------------------------------------------------------------------
+
+@jit
+def shared_counts(membership, counts):
+    """Returns reads explained by both groups of every pair of allele groups,
+       given a group by compatibility class membership matrix.
+    """
+    n_groups = membership.shape[0]
+    shared = np.zeros((n_groups, n_groups))
+
+    for k in range(len(counts)):
+        if counts[k] == 0:
+            continue
+        for i in range(n_groups):
+            if membership[i, k] == 0:
+                continue
+            for j in range(i, n_groups):
+                if membership[j, k] != 0:
+                    shared[i, j] += counts[k]
+
+    for i in range(n_groups):
+        for j in range(i):
+            shared[i, j] = shared[j, i]
+
+    return shared
+
+# -------------------------------------------------------------------------------
@@ -64,7 +64,7 @@ def filter_eqs(complete_genotypes, allele_idx, eq_idx, partial_alleles):
                      for allele in alleles}
 
     # Find the indices of sequences derived from these alleles
-    wanted_indices = {index for index, alleles in allele_idx.items()
+    wanted_indices = {index for index, alleles in enumerate(allele_idx)
                       if alleles and
                       (set(alleles) & (partial_alleles | set(all_predicted)))}
 
@@ -92,8 +92,7 @@ def filter_eqs(complete_genotypes, allele_idx, eq_idx, partial_alleles):
         for gene in eq_list:
             for i, (indices, count) in enumerate(eq_list[gene]):
                 for idx in indices:
-                    for allele in allele_idx[idx]:
-                        allele = process_allele(allele, 3)
+                    for allele in allele_idx.names(idx, 3):
                         allele_eq[group][allele].add(i)
 
     return filtered_eqs, allele_eq
@@ -153,7 +152,7 @@ def type_partial(eqs, gene, partial_exons, complete_genotype, partial_alleles,
 
     # Map partial alleles to their possible exon combinations
     for idx in results:
-        alleles = {process_allele(allele, 3) for allele in allele_idx[idx]}
+        alleles = set(allele_idx.names(idx, 3))
         for allele in (alleles - set(complete_genotype)) & partial_alleles:
             for group in eqs.keys():
                 if group[1:-1] in str(sorted(partial_exons[allele].keys())):
@@ -304,6 +303,16 @@ def arg_check_iterations(parser, arg):
         parser.error("The number of iterations must be an integer.")
 
 
+def arg_check_reads(parser, arg):
+    try:
+        value = int(arg)
+    except ValueError:
+        parser.error("The number of reads must be an integer.")
+    if value < 0:
+        parser.error("The number of reads must be positive.")
+    return value
+
+
 def arg_check_threshold(parser, arg):
     try:
         value = float(arg)
@@ -441,6 +450,34 @@ if __name__ == "__main__":
                              "for single-end reads\n  default: 20\n\n",
                         default=20)
 
+    parser.add_argument("--count_reads",
+                        action="store_true",
+                        help="count FASTQ records in a separate pass and " +
+                             "check them against Kallisto's total\n\n",
+                        default=False)
+
+    parser.add_argument("--max_reads",
+                        type=lambda x: arg_check_reads(parser, x),
+                        help="reservoir sample at most this many reads, or " +
+                             "read pairs if paired-end,\n  before " +
+                             "pseudoalignment, 0 to align all reads\n  " +
+                             "default: 0\n\n",
+                        default=0,
+                        metavar="")
+
+    parser.add_argument("--seed",
+                        type=int,
+                        help="random seed\n  default: 0\n\n",
+                        default=0,
+                        metavar="")
+
+    parser.add_argument("--collapse",
+                        action="store_true",
+                        help="pseudoalign identical reads or read pairs " +
+                             "once, scaling their class counts\n  " +
+                             "by their multiplicity\n\n",
+                        default=False)
+
     parser.add_argument("--single",
                         action="store_true",
                         help="Include flag if single-end reads. Default is paired-end.\n\n",
@@ -487,32 +524,28 @@ if __name__ == "__main__":
     check_ref()
 
     # Loads reference information
-    # with open(partial_p, 'rb') as file:
-    #    reference_info = pickle.load(file)
-    #    (commithash, (gene_set, allele_idx, exon_idx,
-    #        lengths, partial_exons, partial_alleles)) = reference_info
-    with open(partial_json, "r") as file:
-        reference_info = json.load(file)
-        (commithash, (gene_set, allele_idx, exon_idx,
-                      lengths, partial_exons, partial_alleles)) = reference_info
-        gene_set = set(gene_set)
-        allele_idx = json.loads(allele_idx)
-        exon_idx = json.loads(exon_idx)
-        lengths = json.loads(lengths)
-        lengths = dict([a, int(x)] for a, x in lengths.items())
-        partial_exons = json.loads(partial_exons)
-        partial_alleles = set(partial_alleles)
+    reference = load_reference(partial_json)
+    commithash = reference.commithash
+    allele_idx = reference.allele_idx
+    lengths = reference.lengths
+    partial_exons = reference.partial_exons
+    partial_alleles = reference.partial_alleles
 
     log.info("[log] Reference: %s", commithash)
     hline()
 
     # Runs transcript assembly if intermediate json not provided
     if args.file[0].endswith(".partial_alignment.p"):
-        alignment_info = load_alignment(args.file[0], commithash, True)
+        alignment_info = load_alignment(args.file[0], commithash, True,
+                                        args.genes)
     else:
         alignment_info = get_alignment(args.file, sample, partial_idx,
-                                       reference_info, outdir, temp,
-                                       args.threads, args.single, True, args.avg, args.std)
+                                       reference, outdir, temp,
+                                       args.threads, args.single, args.avg,
+                                       args.std, args.count_reads,
+                                       collapse=args.collapse,
+                                       max_reads=args.max_reads,
+                                       seed=args.seed)
     commithash, eq_idx, _, paired, align_stats, _ = alignment_info
 
     # Load alleles from arcasHLA genotype
@@ -39,6 +39,7 @@ from Bio.SeqRecord import SeqRecord
 from scipy import stats
 
 from arcas_utilities import *
+from tables import compile_reference
 
 # -------------------------------------------------------------------------------
 
@@ -293,6 +294,9 @@ def write_reference(sequences, info, fasta, idx, database, type):
                                     json.dumps(info[4], cls=NumpyEncoder), list(info[5])]],
                       file)
 
+    # Compiled companion loaded by genotype and partial
+    compile_reference(database)
+
     run_command(["kallisto", "index", "-i", idx, fasta],
                 "[reference] indexing " + type + " reference with Kallisto:")
 
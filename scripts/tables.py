@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+#   tables.py: decoded reference tables and their compiled binary cache.
+# -------------------------------------------------------------------------------
+
+# -------------------------------------------------------------------------------
+#   This file is part of arcasHLA.
+#
+#   arcasHLA is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   arcasHLA is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with arcasHLA.  If not, see <https://www.gnu.org/licenses/>.
+# -------------------------------------------------------------------------------
+
+import json
+import logging as log
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from arcas_utilities import AlleleIndex, get_gene, intern_indices
+from container import read_container, read_header, write_container
+
+# -------------------------------------------------------------------------------
+
+__version__ = "0.4.0"
+__date__ = "2022-01-27"
+
+# -------------------------------------------------------------------------------
+
+# Compiled references start with this magic, followed by a JSON header
+# carrying the format version, the commithash and the size and modification
+# time of the JSON reference they were compiled from
+reference_magic = b"ARCASREF"
+reference_version = 1
+
+
+def get_gene_codes(allele_idx):
+    """Returns the genes in the reference and, for each reference index,
+       the position of its gene, -1 if it has no HLA alleles or -2 if its
+       alleles belong to several genes.
+    """
+    genes = dict()
+    codes = np.full(len(allele_idx), -1, dtype=np.int64)
+    for idx, alleles in enumerate(allele_idx):
+        if not alleles:
+            continue
+        idx_genes = {get_gene(allele) for allele in alleles}
+        if len(idx_genes) > 1:
+            codes[idx] = -2
+        else:
+            codes[idx] = genes.setdefault(idx_genes.pop(), len(genes))
+
+    return list(genes), codes
+
+
+# -------------------------------------------------------------------------------
+#   Reference tables
+# -------------------------------------------------------------------------------
+
+class Reference:
+    """Reference tables decoded from hla.p.json or hla_partial.p.json,
+       holding the alleles, lengths and gene of each reference index.
+    """
+
+    def __init__(self, commithash, gene_set, allele_idx, lengths,
+                 gene_length=None, exon_idx=None, partial_exons=None,
+                 partial_alleles=None, gene_codes=None):
+        self.commithash = commithash
+        self.partial = exon_idx is not None
+        self.gene_set = set(gene_set)
+        self.allele_idx = allele_idx
+        self.lengths = lengths
+        self.gene_length = gene_length
+        self.exon_idx = exon_idx
+        self.partial_exons = partial_exons
+        self.partial_alleles = partial_alleles
+
+        if gene_codes is None:
+            gene_codes = get_gene_codes(allele_idx)
+        self.genes, self.gene_codes = gene_codes
+
+    @classmethod
+    def from_json(cls, file):
+        """Decodes a JSON reference, whose tables are JSON strings."""
+        with open(file, "r") as handle:
+            commithash, info = json.load(handle)
+
+        allele_idx = AlleleIndex(intern_indices(json.loads(info[1])))
+
+        if len(info) == 6:
+            _, _, exon_idx, lengths, partial_exons, partial_alleles = info
+            lengths = np.array(intern_indices(json.loads(lengths), 0))
+            return cls(commithash, info[0], allele_idx, lengths,
+                       exon_idx=intern_indices(json.loads(exon_idx)),
+                       partial_exons=json.loads(partial_exons),
+                       partial_alleles=set(partial_alleles))
+
+        _, _, lengths, gene_length = info
+        lengths = np.array(intern_indices(json.loads(lengths), 0))
+        gene_length = {gene: int(length) for gene, length
+                       in json.loads(gene_length).items()}
+        return cls(commithash, info[0], allele_idx, lengths, gene_length)
+
+    @classmethod
+    def from_cache(cls, file):
+        """Loads a compiled reference, checking its arrays' checksums."""
+        header, arrays = read_container(file, reference_magic)
+
+        names = arrays["names"].tobytes().decode().split("\n")
+        defined = arrays["defined"].tolist()
+        offsets = arrays["allele_offsets"].tolist()
+
+        # Rows of names by reference index, None where it has no alleles
+        def read_rows(ids, row_type):
+            named = [names[i] for i in ids.tolist()]
+            return [row_type(named[offsets[i]:offsets[i + 1]])
+                    if defined[i] else None for i in range(len(defined))]
+
+        resolutions = {n: read_rows(arrays[f"resolution_{n}"], tuple)
+                       for n in (1, 2, 3)}
+        allele_idx = AlleleIndex(read_rows(arrays["alleles"], list),
+                                 resolutions)
+        gene_codes = (header["genes"], arrays["gene_codes"])
+
+        if not header["partial"]:
+            return cls(header["commithash"], header["gene_set"], allele_idx,
+                       arrays["lengths"], header["gene_length"],
+                       gene_codes=gene_codes)
+
+        exons = header["exons"]
+        exon_idx = [exons[code] if code >= 0 else None
+                    for code in arrays["exon_codes"].tolist()]
+
+        exon_numbers = header["exon_numbers"]
+        exon_offsets = arrays["partial_exon_offsets"].tolist()
+        numbers = arrays["partial_exon_numbers"].tolist()
+        coords = arrays["partial_exon_coords"].tolist()
+        partial_exons = dict()
+        for i, name in enumerate(arrays["partial_exon_alleles"].tolist()):
+            partial_exons[names[name]] = {
+                exon_numbers[numbers[k]]: coords[k]
+                for k in range(exon_offsets[i], exon_offsets[i + 1])}
+
+        partial_alleles = {names[i]
+                           for i in arrays["partial_alleles"].tolist()}
+
+        return cls(header["commithash"], header["gene_set"], allele_idx,
+                   arrays["lengths"], exon_idx=exon_idx,
+                   partial_exons=partial_exons,
+                   partial_alleles=partial_alleles, gene_codes=gene_codes)
+
+    def write_cache(self, file, source):
+        """Writes the tables as a compiled reference. Allele names are stored
+           once and referred to by position.
+        """
+        name_ids = dict()
+
+        # Positions of names, adding those not yet stored
+        def get_ids(names):
+            return [name_ids.setdefault(name, len(name_ids))
+                    for name in names]
+
+        rows = [alleles or [] for alleles in self.allele_idx]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(alleles) for alleles in rows], out=offsets[1:])
+
+        arrays = dict()
+        arrays["defined"] = np.array([alleles is not None
+                                      for alleles in self.allele_idx],
+                                     dtype=bool)
+        arrays["allele_offsets"] = offsets
+        arrays["alleles"] = np.array(get_ids(allele for alleles in rows
+                                             for allele in alleles),
+                                     dtype=np.int32)
+        for n in (1, 2, 3):
+            arrays[f"resolution_{n}"] = np.array(
+                get_ids(name for names in self.allele_idx.resolutions[n]
+                        for name in names or []),
+                dtype=np.int32)
+        arrays["lengths"] = np.asarray(self.lengths)
+        arrays["gene_codes"] = np.asarray(self.gene_codes)
+
+        header = {"version": reference_version,
+                  "commithash": self.commithash,
+                  "source": source,
+                  "partial": self.partial,
+                  "gene_set": sorted(self.gene_set),
+                  "genes": list(self.genes),
+                  "gene_length": self.gene_length}
+
+        if self.partial:
+            exons = sorted({exon for exon in self.exon_idx if exon})
+            exon_codes = {exon: i for i, exon in enumerate(exons)}
+            arrays["exon_codes"] = np.array([exon_codes.get(exon, -1)
+                                             for exon in self.exon_idx],
+                                            dtype=np.int32)
+
+            allele_exons = [sorted(self.partial_exons[allele].items())
+                            for allele in sorted(self.partial_exons)]
+            exon_numbers = sorted({number for items in allele_exons
+                                   for number, _ in items})
+            number_codes = {number: i for i, number in enumerate(exon_numbers)}
+            exon_offsets = np.zeros(len(allele_exons) + 1, dtype=np.int64)
+            np.cumsum([len(items) for items in allele_exons],
+                      out=exon_offsets[1:])
+
+            arrays["partial_exon_alleles"] = np.array(
+                get_ids(sorted(self.partial_exons)), dtype=np.int32)
+            arrays["partial_exon_offsets"] = exon_offsets
+            arrays["partial_exon_numbers"] = np.array(
+                [number_codes[number] for items in allele_exons
+                 for number, _ in items], dtype=np.int32)
+            arrays["partial_exon_coords"] = np.array(
+                [coords for items in allele_exons for _, coords in items],
+                dtype=np.int64).reshape(-1, 2)
+            arrays["partial_alleles"] = np.array(
+                get_ids(sorted(self.partial_alleles)), dtype=np.int32)
+
+            header.update(exons=exons, exon_numbers=exon_numbers)
+
+        names = "\n".join(name_ids).encode()
+        arrays["names"] = np.frombuffer(names, dtype=np.uint8)
+
+        write_container(file, reference_magic, header, arrays)
+
+
+# -------------------------------------------------------------------------------
+#   Compiled reference cache
+# -------------------------------------------------------------------------------
+
+def reference_cache(file):
+    """Returns the compiled companion of a JSON reference."""
+    return os.path.splitext(file)[0] + ".bin"
+
+
+def source_stamp(file):
+    """Returns the size and modification time a cache is checked against."""
+    stat = os.stat(file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def is_current(cache, file):
+    """Checks if a compiled reference matches this version and, if the JSON
+       reference exists, was compiled from it.
+    """
+    try:
+        header, _ = read_header(cache, reference_magic)
+    except (OSError, ValueError):
+        return False
+
+    if header.get("version") != reference_version:
+        return False
+    return not os.path.isfile(file) or header["source"] == source_stamp(file)
+
+
+def compile_reference(file):
+    """Decodes a JSON reference and writes its compiled companion, returning
+       the reference. The cache is written to a temporary file and moved in
+       place, so that concurrent jobs never read a partial cache.
+    """
+    reference = Reference.from_json(file)
+
+    cache = reference_cache(file)
+    temp = f"{cache}.{os.getpid()}.tmp"
+    try:
+        reference.write_cache(temp, source_stamp(file))
+        os.replace(temp, cache)
+    except OSError as err:
+        log.warning("[reference] Could not write %s: %s", cache, err)
+        if os.path.isfile(temp):
+            os.remove(temp)
+
+    return reference
+
+
+@lru_cache(maxsize=None)
+def load_reference(file):
+    """Loads a reference once per process from its compiled companion,
+       compiling it from JSON if it is missing, stale or corrupted.
+    """
+    cache = reference_cache(file)
+    if is_current(cache, file):
+        try:
+            return Reference.from_cache(cache)
+        except ValueError as err:
+            log.warning("[reference] %s, recompiling", err)
+
+    return compile_reference(file)
+
+# -------------------------------------------------------------------------------
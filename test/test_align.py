@@ -0,0 +1,274 @@
+# Test processing of pseudoalignment output
+import gzip
+import json
+import os
+import pickle
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, f"{ROOT_DIR}/scripts")
+
+import pytest
+
+import align
+from align import (EqClasses, get_processed_reads, load_alignment,
+                   merge_pseudoalignments, process_counts,
+                   pseudoalign_shared, read_pseudoalignments, share_threads,
+                   stream_fastq, write_alignment)
+from arcas_utilities import AlleleIndex
+from container import read_header
+
+
+KALLISTO_STDERR = """
+[quant] fragment length distribution will be estimated from the data
+[index] k-mer length: 31
+[quant] finding pseudoalignments for the reads ... done
+[quant] processed 1,234,567 reads, 1,000,002 reads pseudoaligned
+"""
+
+# Reference index 3 is a non-HLA transcript
+ALLELE_IDX = AlleleIndex([["A*01:01:01"], ["A*02:01:01"], ["B*07:02:01"],
+                          None, ["B*08:01:01"]])
+
+
+def write_pseudoalignments(path):
+    with open(path / "pseudoalignments.ec", "w") as file:
+        file.write("0\t0\n1\t1\n2\t0,1\n3\t2,4\n4\t1,2\n5\t0,3\n6\t4\n")
+    # Counts are not necessarily in class order
+    with open(path / "pseudoalignments.tsv", "w") as file:
+        file.write("6\t0\n0\t10\n1\t5\n2\t7\n3\t3\n4\t4\n5\t9\n")
+    return str(path / "pseudoalignments.tsv"), str(path / "pseudoalignments.ec")
+
+
+def test_read_pseudoalignments(tmp_path):
+    offsets, indices, counts = read_pseudoalignments(
+        *write_pseudoalignments(tmp_path), chunk_size=7)
+
+    assert offsets.tolist() == [0, 1, 2, 4, 6, 8, 10, 11]
+    assert indices.tolist() == [0, 1, 0, 1, 2, 4, 1, 2, 0, 3, 4]
+    assert counts.tolist() == [10, 5, 7, 3, 4, 9, 0]
+
+
+def test_process_counts(tmp_path):
+    eq_idx, allele_eq, align_stats = process_counts(
+        *write_pseudoalignments(tmp_path), None, ALLELE_IDX, None)
+
+    assert dict(eq_idx) == {"A": [([0], 10.0), ([1], 5.0), ([0, 1], 7.0)],
+                            "B": [([2, 4], 3.0)]}
+    assert dict(allele_eq) == {0: {0, 2}, 1: {1, 2}, 2: {0}, 4: {0}}
+    # Classes with non-HLA transcripts are not counted
+    assert align_stats == [25.0, 4.0]
+
+
+def test_processed_reads_from_run_info(tmp_path):
+    with open(tmp_path / "run_info.json", "w") as file:
+        json.dump({"n_processed": 2500, "n_pseudoaligned": 2000}, file)
+
+    assert get_processed_reads(f"{tmp_path}/", KALLISTO_STDERR) == 2500
+
+
+def test_processed_reads_from_stderr(tmp_path):
+    assert get_processed_reads(f"{tmp_path}/", KALLISTO_STDERR) == 1234567
+    assert get_processed_reads(f"{tmp_path}/", "") is None
+
+
+def test_alignment_round_trip(tmp_path):
+    eq_idx, allele_eq, align_stats = process_counts(
+        *write_pseudoalignments(tmp_path), None, ALLELE_IDX, None)
+    gene_stats = {"A": [22.0, 3, 0.8], "B": [3.0, 1, 0.2]}
+    alignment_info = ["commithash", eq_idx, allele_eq, True,
+                      align_stats + [40, 200, 20], gene_stats]
+    file = str(tmp_path / "sample.alignment.p")
+
+    write_alignment(file, alignment_info)
+    loaded = load_alignment(file, "commithash")
+
+    assert {gene: list(eqs) for gene, eqs in loaded[1].items()} == eq_idx
+    assert isinstance(loaded[1]["A"], EqClasses)
+    assert loaded[1]["A"][2] == ([0, 1], 7.0)
+    assert dict(loaded[2]) == dict(allele_eq)
+    assert loaded[3:] == alignment_info[3:]
+
+
+def test_eq_classes_indexing():
+    eqs = EqClasses.from_list([([0, 1], 3.0), ([2], 4.0), ([1, 4], 1.0)])
+
+    assert [eqs[i] for i in range(-3, 3)] == list(eqs) + list(eqs)
+    assert eqs[-1] == ([1, 4], 1.0)
+    assert eqs[-2:] == [([2], 4.0), ([1, 4], 1.0)]
+    for i in [3, -4]:
+        with pytest.raises(IndexError):
+            eqs[i]
+
+
+def test_partial_alignment_round_trip(tmp_path):
+    eq_idx = {"0": defaultdict(list), "1": defaultdict(list)}
+    eq_idx["1"]["A"] = [([0, 1], 3.0), ([1], 2.0)]
+    alignment_info = ["commithash", eq_idx, [], False, [5.0, 0.0, 10, 200, 20],
+                      []]
+    file = str(tmp_path / "sample.partial_alignment.p")
+
+    write_alignment(file, alignment_info, True)
+    loaded = load_alignment(file, "commithash", True)
+
+    assert list(loaded[1]) == ["0", "1"]
+    assert not loaded[1]["0"]
+    assert list(loaded[1]["1"]["A"]) == eq_idx["1"]["A"]
+
+
+def test_load_legacy_pickle(tmp_path):
+    eq_idx = {"A": [(["0", "1"], 3.0), (["1"], 2.0)]}
+    allele_eq = {"0": {0}, "1": {0, 1}}
+    file = str(tmp_path / "sample.alignment.p")
+    with open(file, "wb") as handle:
+        pickle.dump(["commithash", eq_idx, allele_eq, True,
+                     [5.0, 0.0, 10, 200, 20], {"A": [5.0, 2, 1.0]}], handle)
+
+    loaded = load_alignment(file, "commithash")
+
+    assert loaded[1] == {"A": [([0, 1], 3.0), ([1], 2.0)]}
+    assert dict(loaded[2]) == {0: {0}, 1: {0, 1}}
+
+
+def test_corrupted_alignment(tmp_path):
+    eq_idx = {"A": [([0, 1], 3.0), ([1], 2.0)]}
+    file = str(tmp_path / "sample.alignment.p")
+    write_alignment(file, ["commithash", eq_idx, None, True,
+                           [5.0, 0.0, 10, 200, 20], {"A": [5.0, 2, 1.0]}])
+
+    # Overwrites the first class offset
+    _, start = read_header(file, b"ARCASALN")
+    with open(file, "r+b") as handle:
+        handle.seek(start)
+        handle.write(b"\xff")
+
+    with pytest.raises(ValueError):
+        load_alignment(file, "commithash")
+
+
+def test_load_alignment_genes(tmp_path):
+    eq_idx, allele_eq, align_stats = process_counts(
+        *write_pseudoalignments(tmp_path), None, ALLELE_IDX, None)
+    gene_stats = {"A": [22.0, 3, 0.8], "B": [3.0, 1, 0.2]}
+    alignment_info = ["commithash", eq_idx, allele_eq, True,
+                      align_stats + [40, 200, 20], gene_stats]
+
+    binary = str(tmp_path / "sample.alignment.p")
+    write_alignment(binary, alignment_info)
+    legacy = str(tmp_path / "legacy.alignment.p")
+    with open(legacy, "wb") as handle:
+        pickle.dump(alignment_info, handle)
+
+    for file in (binary, legacy):
+        loaded = load_alignment(file, "commithash", genes=["B"])
+
+        assert {gene: list(eqs) for gene, eqs in loaded[1].items()} == \
+            {"B": eq_idx["B"]}
+        assert dict(loaded[2]) == {2: {0}, 4: {0}}
+        assert loaded[5] == gene_stats
+
+
+def test_stream_fastq(tmp_path):
+    data = b"".join(b"@read%d\nACGT\n+\nIIII\n" % i for i in range(5000))
+    fq = str(tmp_path / "reads.fastq.gz")
+    with gzip.open(fq, "wb") as file:
+        file.write(data)
+
+    fifos = [str(tmp_path / f"reads_{i}.fq") for i in range(3)]
+    for fifo in fifos:
+        os.mkfifo(fifo)
+
+    errors = []
+    threads = stream_fastq(fq, fifos, errors, chunk_size=100, max_chunks=2)
+
+    def read_fifo(fifo, size):
+        with open(fifo, "rb") as file:
+            return file.read(size)
+
+    # A reader that exits early does not stall the others
+    with ThreadPoolExecutor(3) as executor:
+        reads = list(executor.map(read_fifo, fifos, [-1, -1, 10]))
+    assert reads == [data, data, data[:10]]
+
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_merge_pseudoalignments(tmp_path):
+    # Runs over reads with multiplicity 1 and 2, numbering the classes they
+    # add after the index's own classes differently
+    runs = [tmp_path / "run_0", tmp_path / "run_1"]
+    for run in runs:
+        run.mkdir()
+    with open(runs[0] / "pseudoalignments.ec", "w") as file:
+        file.write("0\t0\n1\t1\n2\t0,1\n3\t2,4\n")
+    with open(runs[0] / "pseudoalignments.tsv", "w") as file:
+        file.write("0\t4\n1\t0\n2\t1\n3\t2\n")
+    with open(runs[1] / "pseudoalignments.ec", "w") as file:
+        file.write("0\t0\n1\t1\n2\t2,4\n3\t1,2\n")
+    with open(runs[1] / "pseudoalignments.tsv", "w") as file:
+        file.write("0\t3\n1\t1\n2\t5\n3\t2\n")
+
+    merge_pseudoalignments([f"{run}/" for run in runs], [1, 2],
+                           f"{tmp_path}/")
+    offsets, indices, counts = read_pseudoalignments(
+        str(tmp_path / "pseudoalignments.tsv"),
+        str(tmp_path / "pseudoalignments.ec"))
+
+    classes = [indices[offsets[i]:offsets[i + 1]].tolist()
+               for i in range(len(counts))]
+    assert classes == [[0], [1], [0, 1], [2, 4], [1, 2]]
+    assert counts.tolist() == [10, 2, 1, 12, 4]
+
+
+@pytest.mark.parametrize("sizes, threads, expected", [
+    ([100, 10, 1], 8, [6, 1, 1]),
+    ([50, 50], 5, [3, 2]),
+    ([5, 5, 5], 2, [1, 1, 1]),
+    ([0, 0], 4, [2, 2])])
+def test_share_threads(sizes, threads, expected):
+    run_threads = share_threads(sizes, threads)
+
+    assert run_threads == expected
+    assert sum(run_threads) == max(threads, len(sizes))
+
+
+@pytest.mark.parametrize("threads, expected", [("8", ["4", "4"]),
+                                               ("5", ["3", "2"])])
+def test_pseudoalign_shared_threads(tmp_path, monkeypatch, threads,
+                                    expected):
+    fq = str(tmp_path / "reads.fq")
+    with open(fq, "w") as file:
+        file.write("@read\nACGT\n+\nIIII\n")
+    temps = []
+    for name in ["complete", "partial"]:
+        (tmp_path / name).mkdir()
+        temps.append(f"{tmp_path / name}/")
+
+    # Stands in for Kallisto, reading its pipe to the end
+    class Kallisto:
+        commands = []
+
+        def __init__(self, command, stdout, stderr):
+            self.commands.append(command)
+            with open(command[-1], "rb") as file:
+                file.read()
+
+        def wait(self):
+            return 0
+
+        def poll(self):
+            return 0
+
+    monkeypatch.setattr(align, "Popen", Kallisto)
+
+    pseudoalign_shared([fq], False, ["complete.idx", "partial.idx"], temps,
+                       threads, 200, 20)
+
+    # The runs split the threads rather than each using all of them
+    assert [command[command.index("-t") + 1]
+            for command in Kallisto.commands] == expected
@@ -0,0 +1,233 @@
+# Test selection of regions for extraction
+import argparse
+import json
+import sys
+from os.path import dirname, abspath
+from types import SimpleNamespace
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, f"{ROOT_DIR}/scripts")
+
+import pytest
+
+import extract
+from extract import (arg_check_level, fastq_command, get_regions,
+                     get_sequence_lengths, get_sort_order, group_mates,
+                     split_threads)
+
+
+with open(f"{ROOT_DIR}/dat/info/mhc_regions.json") as file:
+    MHC_REGIONS = json.load(file)
+
+with open(f"{ROOT_DIR}/dat/info/decoys_alts.json") as file:
+    ALTS = json.load(file)
+
+
+def make_header(sequences):
+    lines = ["@HD\tVN:1.6\tSO:coordinate"]
+    lines.extend(f"@SQ\tSN:{name}\tLN:{length}"
+                 for name, length in sequences)
+    lines.append("@PG\tID:samtools\tPN:samtools")
+    return "\n".join(lines) + "\n"
+
+
+@pytest.mark.parametrize("build, chrom, length, start, end", [
+    ("GRCh38", "chr6", 170805979, 28510119, 33480577),
+    ("GRCh37", "6", 171115067, 28477796, 33448354)])
+def test_mhc_regions(build, chrom, length, start, end):
+    header = make_header([(chrom.replace("6", "5"), 181538259),
+                          (chrom, length), ("HSCHR6_MHC_COX", 4795371),
+                          ("HLA-A*01:01:01:01", 3503)])
+
+    regions, found = get_regions(get_sequence_lengths(header), chrom, ALTS,
+                                 MHC_REGIONS)
+
+    assert found == build
+    assert regions == [(chrom, start, end), ("HSCHR6_MHC_COX", 0, 4795371),
+                       ("HLA-A*01:01:01:01", 0, 3503)]
+
+
+def test_unknown_build_regions():
+    header = make_header([("chr6", 170000000), ("chr7", 159345973)])
+
+    regions, found = get_regions(get_sequence_lengths(header), "chr6", ALTS,
+                                 MHC_REGIONS)
+
+    assert found is None
+    assert regions == [("chr6", 0, 170000000)]
+
+
+@pytest.mark.parametrize("sort_order", ["coordinate", "unsorted",
+                                        "queryname"])
+def test_get_sort_order(sort_order):
+    header = make_header([("chr6", 170805979)]).replace("SO:coordinate",
+                                                        f"SO:{sort_order}")
+
+    assert get_sort_order(header) == sort_order
+
+
+@pytest.mark.parametrize("paired", [True, False])
+def test_group_mates(paired):
+    command = group_mates(paired, "/tmp/", "sample", "4")
+
+    assert (command is not None) == paired
+    if paired:
+        assert command.startswith("samtools collate -O -f")
+        assert command.endswith("/tmp/sample.collate")
+
+
+def test_missing_sort_order():
+    assert get_sort_order("@SQ\tSN:chr6\tLN:170805979\n") is None
+
+
+@pytest.mark.parametrize("fqs, level, outputs", [
+    (["s.1.fq", "s.2.fq"], 1, "-1 s.1.fq.gz -2 s.2.fq.gz -0 /dev/null"),
+    (["s.1.fq", "s.2.fq"], 0, "-1 s.1.fq -2 s.2.fq -0 /dev/null"),
+    (["s.fq"], 6, "-0 s.fq.gz -o s.fq.gz")])
+def test_fastq_command(fqs, level, outputs):
+    command = fastq_command(fqs, "4", level)
+
+    assert command.startswith(f"samtools fastq -n -c {level} -@4 ")
+    assert outputs in command
+    assert command.endswith(" -")
+
+
+@pytest.mark.parametrize("threads, n_views, collate, level, expected", [
+    ("1", 3, True, 6, (1, 0, 0)),
+    ("8", 3, True, 6, (3, 1, 4)),
+    ("8", 1, False, 0, (8, 0, 0)),
+    ("16", 4, True, 1, (8, 2, 6))])
+def test_split_threads(threads, n_views, collate, level, expected):
+    view_threads, collate_threads, fastq_threads = split_threads(
+        threads, n_views, collate, level)
+
+    assert (view_threads, collate_threads, fastq_threads) == expected
+    assert view_threads + collate_threads + fastq_threads == int(threads)
+    assert view_threads % min(view_threads, n_views) == 0
+
+
+@pytest.mark.parametrize("paired, mapped, unmapped, command", [
+    (True, ["-f", "2"], ["-f", "12"],
+     "samtools collate -O -f -l 1 -@1 - tmp/s.collate | "
+     "samtools fastq -n -c 6 -@4 -1 out/s.extracted.1.fq.gz "
+     "-2 out/s.extracted.2.fq.gz -0 /dev/null -s /dev/null -"),
+    (False, ["-F", "4"], ["-f", "4"],
+     "samtools fastq -n -c 6 -@2 -0 out/s.extracted.fq.gz "
+     "-o out/s.extracted.fq.gz -")])
+def test_extract_commands(monkeypatch, paired, mapped, unmapped, command):
+    header = make_header([("chr6", 170805979), ("HSCHR6_MHC_COX", 4795371)])
+    calls = []
+    monkeypatch.setattr(extract, "index_bam", lambda bam: None)
+    monkeypatch.setattr(extract, "run_command", lambda *args: SimpleNamespace(
+        stdout=header.encode(), returncode=0))
+    monkeypatch.setattr(extract, "stream_views",
+                        lambda *args: calls.append(args[:5]))
+
+    extract.extract_reads("bam/s.bam", "out/", paired, True, ALTS, "tmp/",
+                          "8", None, 6)
+
+    [(views, streamed_header, streamed_command, temp, threads)] = calls
+    assert views == [mapped + ["bam/s.bam", "chr6"],
+                     mapped + ["bam/s.bam", "HSCHR6_MHC_COX:"],
+                     unmapped + ["bam/s.bam"]]
+    assert streamed_header == header
+    assert streamed_command.split() == command.split()
+    assert temp == "tmp/"
+    assert threads == (3 if paired else 6)
+
+
+@pytest.mark.parametrize("paired, command", [
+    (True, "samtools collate -O -f -l 1 -@1 - tmp/s.collate | "
+           "samtools fastq -n -c 0 -@0 -1 out/s.extracted.1.fq "
+           "-2 out/s.extracted.2.fq -0 /dev/null -s /dev/null -"),
+    (False, "samtools fastq -n -c 0 -@0 -0 out/s.extracted.fq "
+            "-o out/s.extracted.fq -")])
+def test_extract_uncompressed(monkeypatch, paired, command):
+    header = make_header([("chr6", 170805979)])
+    calls = []
+    monkeypatch.setattr(extract, "index_bam", lambda bam: None)
+    monkeypatch.setattr(extract, "run_command", lambda *args: SimpleNamespace(
+        stdout=header.encode(), returncode=0))
+    monkeypatch.setattr(extract, "stream_views",
+                        lambda *args: calls.append(args[:5]))
+
+    extract.extract_reads("bam/s.bam", "out/", paired, False, ALTS, "tmp/",
+                          "8", None, 0)
+
+    # Level 0 writes plain FASTQ and leaves the compression threads to views
+    [(_, _, streamed_command, _, threads)] = calls
+    assert streamed_command.split() == command.split()
+    assert ".gz" not in streamed_command
+    assert threads == (7 if paired else 8)
+
+
+@pytest.mark.parametrize("arg, expected", [
+    ("0", 0), ("9", 9), ("-1", None), ("10", None), ("fast", None)])
+def test_arg_check_level(arg, expected):
+    parser = argparse.ArgumentParser()
+
+    if expected is None:
+        with pytest.raises(SystemExit):
+            arg_check_level(parser, arg)
+    else:
+        assert arg_check_level(parser, arg) == expected
+
+
+@pytest.mark.parametrize("paired, command", [
+    (True, "samtools view -u -@7 bam/s.bam | "
+           "samtools collate -O -f -l 1 -@1 - tmp/s.collate | "
+           "samtools fastq -n -c 0 -@0 -1 out/s.1.fq -2 out/s.2.fq "
+           "-0 /dev/null -s /dev/null -"),
+    (False, "samtools view -u -@8 bam/s.bam | "
+            "samtools fastq -n -c 0 -@0 -0 out/s.fq -o out/s.fq -")])
+def test_bam_to_fastq_commands(monkeypatch, paired, command):
+    header = make_header([("chr6", 170805979)])
+    calls = []
+
+    def run_command(command, message=""):
+        calls.append(command)
+        return SimpleNamespace(stdout=header.encode(), returncode=0)
+
+    monkeypatch.setattr(extract, "run_command", run_command)
+
+    extract.bam_to_fastq("bam/s.bam", "out/", paired, "tmp/", "8", 0)
+
+    assert calls[-1].split() == command.split()
+
+
+@pytest.mark.parametrize("sort_order, collated", [
+    ("coordinate", True), ("queryname", False)])
+def test_bam_to_fastq_sort_order(monkeypatch, sort_order, collated):
+    header = make_header([("chr6", 170805979)]).replace("SO:coordinate",
+                                                        f"SO:{sort_order}")
+    calls = []
+
+    def run_command(command, message=""):
+        calls.append(command)
+        return SimpleNamespace(stdout=header.encode(), returncode=0)
+
+    monkeypatch.setattr(extract, "run_command", run_command)
+
+    extract.bam_to_fastq("bam/s.bam", "out/", True, "tmp/", "8", 6)
+
+    # A single view of a BAM sorted by name keeps mates together
+    assert ("samtools collate" in calls[-1]) == collated
+
+
+def test_extract_collates_name_sorted(monkeypatch):
+    header = make_header([("chr6", 170805979)]).replace("SO:coordinate",
+                                                        "SO:queryname")
+    calls = []
+    monkeypatch.setattr(extract, "index_bam", lambda bam: None)
+    monkeypatch.setattr(extract, "run_command", lambda *args: SimpleNamespace(
+        stdout=header.encode(), returncode=0))
+    monkeypatch.setattr(extract, "stream_views",
+                        lambda *args: calls.append(args[:5]))
+
+    extract.extract_reads("bam/s.bam", "out/", True, True, ALTS, "tmp/",
+                          "8", None, 6)
+
+    # Concurrent views interleave mates whatever the sort order
+    [(views, _, command, _, _)] = calls
+    assert len(views) == 2
+    assert command.startswith("samtools collate -O -f")
@@ -0,0 +1,109 @@
+# Test streaming FASTQ statistics on plain and gzipped files
+import gzip
+import sys
+from os.path import dirname, abspath
+
+import pytest
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, f"{ROOT_DIR}/scripts")
+
+from collections import Counter
+
+from fastq import collapse_reads, fastq_stats, sample_reads
+
+
+READS = ["ACGT", "ACGTACGT", "A" * 12, "ACG"]
+
+
+def write_fastq(path, reads, compress=False, trailing_newline=True):
+    text = "".join(f"@read{i}\n{read}\n+\n{'I' * len(read)}\n"
+                   for i, read in enumerate(reads))
+    if not trailing_newline:
+        text = text.rstrip("\n")
+
+    opener = gzip.open if compress else open
+    with opener(path, "wt") as file:
+        file.write(text)
+    return str(path)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("trailing_newline", [False, True])
+def test_fastq_stats_counts_records(tmp_path, compress, trailing_newline):
+    # Gzipped input is detected from its contents, not the file name
+    fq = write_fastq(tmp_path / "reads.fq", READS, compress, trailing_newline)
+
+    stats = fastq_stats([fq, fq])
+
+    assert stats.records == 2 * len(READS)
+    assert stats.length_histogram is None
+
+
+def test_fastq_stats_bounded_histogram(tmp_path):
+    fq1 = write_fastq(tmp_path / "reads.1.fq.gz", READS, compress=True)
+    fq2 = write_fastq(tmp_path / "reads.2.fq", READS[:2])
+
+    stats = fastq_stats([fq1, fq2], histogram=True, max_length=10)
+
+    assert stats.records == 6
+    assert len(stats.length_histogram) == 11
+    assert stats.length_histogram[3] == 1
+    assert stats.length_histogram[4] == 2
+    assert stats.length_histogram[8] == 2
+    assert stats.length_histogram[10] == 1
+
+
+def test_fastq_stats_empty(tmp_path):
+    fq = write_fastq(tmp_path / "empty.fq.gz", [], compress=True)
+
+    assert fastq_stats([fq]).records == 0
+    assert fastq_stats([fq], histogram=True).records == 0
+
+
+def read_sequences(fq):
+    with open(fq) as file:
+        return [line.rstrip() for line in file][1::4]
+
+
+def test_collapse_read_pairs(tmp_path):
+    # Pairs are collapsed only if both mates match
+    mates = [("ACGT", "TTTT")] * 5 + [("ACGT", "GGGG")] * 2 + [("CCC", "AA")]
+    fq1 = write_fastq(tmp_path / "reads.1.fq.gz", [m[0] for m in mates], True)
+    fq2 = write_fastq(tmp_path / "reads.2.fq.gz", [m[1] for m in mates], True)
+
+    outputs, records, unique = collapse_reads([fq1, fq2],
+                                              str(tmp_path / "collapsed"))
+
+    assert records == 16
+    assert unique == 3
+    assert sorted(outputs) == [0, 1, 2]
+
+    # Multiplicities rebuilt from the bits each pair is written with
+    pairs = Counter()
+    for bit, (out1, out2) in outputs.items():
+        for pair in zip(read_sequences(out1), read_sequences(out2)):
+            pairs[pair] += 2 ** bit
+    assert pairs == Counter(mates)
+
+
+def test_sample_read_pairs(tmp_path):
+    reads = [f"{i:04d}ACGT" for i in range(1000)]
+    fq1 = write_fastq(tmp_path / "reads.1.fq.gz", reads, True)
+    fq2 = write_fastq(tmp_path / "reads.2.fq", reads, False, False)
+
+    outputs, records = sample_reads([fq1, fq2], str(tmp_path / "a"), 100, 7)
+    again, _ = sample_reads([fq1, fq2], str(tmp_path / "b"), 100, 7)
+
+    assert records == 2000
+    sampled = read_sequences(outputs[0])
+    # Mates stay paired, in input order, and the seed fixes the sample
+    assert read_sequences(outputs[1]) == sampled
+    assert sampled == sorted(set(sampled)) and len(sampled) == 100
+    assert read_sequences(again[0]) == sampled
+
+
+def test_sample_reads_below_limit(tmp_path):
+    fq = write_fastq(tmp_path / "reads.fq.gz", READS, True)
+
+    assert sample_reads([fq], str(tmp_path / "sampled"), 10) == ([fq], 4)
@@ -0,0 +1,512 @@
+# Test transcript quantification and genotype prediction on simulated
+# compatibility classes
+import json
+import math
+import pickle
+import random
+import subprocess
+import sys
+from collections import defaultdict
+from os.path import dirname, abspath
+
+import numpy as np
+import pytest
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, f"{ROOT_DIR}/scripts")
+
+import kernels
+from align import load_alignment, write_alignment
+from container import read_header
+from genotype import (bootstrap_gene, check_batch_samples,
+                      expectation_maximization, genotype_batch, genotype_gene,
+                      genotype_genes, predict_genotype)
+from arcas_utilities import (AlleleIndex, capture_log, intern_indices,
+                             process_allele)
+
+
+PRIOR = {
+    "A*01:01": {"prior": 0.02},
+    "A*02:01": {"prior": 0.04},
+    "A*03:01": {"prior": 0.01},
+}
+
+
+def simulate(seed, n_alleles=40, n_eqs=300):
+    """Simulates compatibility classes supported by a pair of alleles."""
+    rnd = random.Random(seed)
+    allele_idx = []
+    lengths = []
+    for _ in range(n_alleles):
+        allele = "A*{:02d}:{:02d}:{:02d}".format(rnd.randint(1, 3),
+                                                 rnd.randint(1, 2),
+                                                 rnd.randint(1, 3))
+        allele_idx.append([allele])
+        lengths.append(rnd.randint(1000, 1100))
+
+    true_alleles = rnd.sample(range(n_alleles), 2)
+    eqs = dict()
+    for _ in range(n_eqs):
+        indices = set(rnd.sample(range(n_alleles), rnd.randint(1, 8)))
+        if rnd.random() < 0.7:
+            indices.add(rnd.choice(true_alleles))
+        indices = tuple(sorted(indices))
+        eqs[indices] = eqs.get(indices, 0) + float(rnd.randint(1, 50))
+
+    return [(list(indices), count) for indices, count in eqs.items()], \
+        lengths, AlleleIndex(allele_idx)
+
+
+def dict_expectation_maximization(eqs, lengths, allele_idx, population, prior,
+                                  tolerance, max_iterations, drop_iterations,
+                                  drop_threshold):
+    """Dictionary-based SQUAREM used before the sparse matrix engine."""
+
+    def counts_to_abundances(counts):
+        abundances = defaultdict(float)
+        for allele, count in counts.items():
+            abundances[allele] = count / lengths[allele]
+        total = sum(abundances.values())
+        for allele, abundance in abundances.items():
+            abundances[allele] = abundance / total
+        return abundances
+
+    def update_abundances(abundances):
+        counts = defaultdict(float)
+        for alleles, count in eqs:
+            alleles = [allele for allele in alleles if allele in abundances]
+            total = sum([abundances[allele] for allele in alleles])
+            if total == 0:
+                continue
+            for allele in alleles:
+                counts[allele] += count * (abundances[allele] / total)
+        return counts_to_abundances(counts)
+
+    def SRSS(theta):
+        return math.sqrt(sum(i ** 2 for i in theta))
+
+    counts = defaultdict(float)
+    for alleles, count in eqs:
+        allele_prior = defaultdict(float)
+        for idx in alleles:
+            allele = process_allele(allele_idx[idx][0], 2)
+            if population and allele in prior:
+                allele_prior[idx] = prior[allele][population]
+        if population and allele_prior:
+            total = sum(allele_prior.values())
+            for allele in alleles:
+                counts[allele] += count * (allele_prior[allele] / total)
+        else:
+            for allele in alleles:
+                counts[allele] += count / len(alleles)
+    theta0 = counts_to_abundances(counts)
+
+    converged = False
+    iterations = 1
+    while iterations < max_iterations and not converged:
+        theta1 = update_abundances(theta0)
+        theta2 = update_abundances(theta1)
+        r = {a: theta1[a] - theta0[a] for a in theta1}
+        v = {a: (theta2[a] - theta1[a]) - r[a] for a in theta1}
+        srss_v = SRSS(v.values())
+        if srss_v != 0:
+            alpha = -(SRSS(r.values()) / srss_v)
+            theta_prime = {a: theta0[a] - 2 * alpha * r[a] + alpha ** 2 * v[a]
+                           for a in r}
+            step_min = min(theta_prime.values())
+            step_max = max(theta_prime.values())
+            if step_min < 0:
+                theta_prime = {a: (x - step_min) / (step_max - step_min)
+                               for a, x in theta_prime.items()}
+                total = sum(theta_prime.values())
+                theta_prime = {a: x / total for a, x in theta_prime.items()}
+            theta_prime = update_abundances(theta_prime)
+        else:
+            theta_prime = theta1
+
+        converged = SRSS([theta_prime[a] - theta0[a] for a in theta0]) \
+            < tolerance
+
+        if iterations == 1:
+            theta_prime = {a: x for a, x in theta_prime.items() if x > 0.0}
+        elif iterations >= drop_iterations or converged:
+            threshold = drop_threshold * max(theta_prime.values())
+            theta_prime = {a: x for a, x in theta_prime.items()
+                           if x >= threshold}
+        theta0 = theta_prime
+        iterations += 1
+
+    return theta0
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("population", [None, "prior"])
+def test_expectation_maximization_matches_dict_engine(seed, population):
+    eqs, lengths, allele_idx = simulate(seed)
+    params = (lengths, allele_idx, population, PRIOR, 10e-7, 1000, 4, 0.1)
+
+    expected = dict_expectation_maximization(eqs, *params)
+    observed = expectation_maximization(eqs, *params)
+
+    assert list(observed) == list(expected)
+    for allele, abundance in expected.items():
+        assert observed[allele] == pytest.approx(abundance, abs=1e-9)
+
+
+def test_predict_genotype_scores_pairs():
+    allele_idx = AlleleIndex([["A*01:01:01:01"], ["A*01:01:02"],
+                              ["A*02:01:01:01"], ["A*03:01:01:01"]])
+    eqs = [([0, 1], 30.0), ([2], 25.0), ([0, 2], 10.0), ([3], 5.0),
+           ([1, 3], 4.0)]
+    allele_eq = defaultdict(set)
+    for i, (indices, _) in enumerate(eqs):
+        for idx in indices:
+            allele_eq[idx].add(i)
+    em_results = [[idx, allele_idx[idx], 0.25] for idx in range(4)]
+
+    genotype, pair_count = predict_genotype(eqs, allele_idx, allele_eq,
+                                            em_results, 74.0, None, PRIOR,
+                                            0.15)
+
+    assert genotype == ["A*01:01:01", "A*02:01:01"]
+    assert pair_count == 69.0
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("population", [None, "prior"])
+def test_jit_kernels_match_numpy(monkeypatch, seed, population):
+    eqs, lengths, allele_idx = simulate(seed)
+    allele_eq = defaultdict(set)
+    for i, (indices, _) in enumerate(eqs):
+        for idx in indices:
+            allele_eq[idx].add(i)
+    params = ("A", sum(count for _, count in eqs), eqs, allele_eq,
+              np.array(lengths, dtype=float), allele_idx, population, PRIOR,
+              10e-7, 1000, 4, 0.1, 0.15)
+
+    monkeypatch.setattr(kernels, "JIT", True)
+    compiled_em, compiled_genotype = genotype_gene(*params)
+    monkeypatch.setattr(kernels, "JIT", False)
+    em, genotype = genotype_gene(*params)
+
+    assert compiled_genotype == genotype
+    assert [idx for idx, _, _ in compiled_em] == [idx for idx, _, _ in em]
+    for (_, _, compiled), (_, _, abundance) in zip(compiled_em, em):
+        assert compiled == pytest.approx(abundance, abs=1e-9)
+
+
+def test_compact_classes_kernel():
+    indptr = np.array([0, 2, 3, 5, 6])
+    indices = np.array([0, 1, 1, 0, 2, 3])
+    counts = np.array([4.0, 3.0, 2.0, 1.0])
+    keep = np.array([True, False, True, False])
+
+    indptr, indices, counts = kernels.compact_classes(indptr, indices,
+                                                      counts, keep)
+
+    assert indptr.tolist() == [0, 1, 3]
+    assert indices.tolist() == [0, 0, 2]
+    assert counts.tolist() == [4.0, 2.0]
+
+
+def test_compact_classes_kernel_merges():
+    # Classes 0, 2 and 4 are left with alleles 0 and 2, in any order
+    indptr = np.array([0, 3, 4, 6, 8, 10])
+    indices = np.array([0, 1, 2, 1, 2, 0, 3, 2, 0, 2])
+    counts = np.array([4.0, 3.0, 2.0, 1.0, 5.0])
+    keep = np.array([True, False, True, False])
+
+    indptr, indices, counts = kernels.compact_classes(indptr, indices,
+                                                      counts, keep)
+
+    assert indptr.tolist() == [0, 2, 3]
+    assert indices.tolist() == [0, 2, 2]
+    assert counts.tolist() == [11.0, 1.0]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_compact_classes_kernel_matches_numpy(seed):
+    eqs, lengths, allele_idx = simulate(seed)
+    rng = np.random.default_rng(seed)
+    keep = rng.random(len(lengths)) < 0.3
+    indptr = np.cumsum([0] + [len(indices) for indices, _ in eqs])
+    indices = np.array([idx for indices, _ in eqs for idx in indices])
+    counts = np.array([count for _, count in eqs])
+
+    new_indptr, new_indices, new_counts = kernels.compact_classes(
+        indptr, indices, counts, keep)
+
+    # The NumPy engine keeps one class per distinct set of kept alleles
+    expected = defaultdict(float)
+    for alleles, count in eqs:
+        alleles = tuple(sorted(idx for idx in alleles if keep[idx]))
+        if alleles:
+            expected[alleles] += count
+    compacted = {tuple(new_indices[new_indptr[i]:new_indptr[i + 1]]):
+                 new_counts[i] for i in range(len(new_counts))}
+
+    assert len(new_counts) == len(expected) < len(eqs)
+    assert compacted == pytest.approx(dict(expected))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_shared_counts_kernel(seed):
+    rng = np.random.default_rng(seed)
+    membership = (rng.random((6, 40)) < 0.3).astype(float)
+    counts = rng.integers(0, 20, 40).astype(float)
+
+    assert kernels.shared_counts(membership, counts) == \
+        pytest.approx((membership * counts) @ membership.T)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_jit_replicates_match_numpy(monkeypatch, seed):
+    eqs, lengths, allele_idx = simulate(seed)
+    params = (lengths, allele_idx, "prior", PRIOR, 10e-7, 1000, 4, 0.1)
+    counts = np.array([count for _, count in eqs])
+    replicate_counts = np.random.default_rng(seed).multinomial(
+        counts.sum(), counts / counts.sum(), size=3).T
+
+    monkeypatch.setattr(kernels, "JIT", True)
+    compiled = expectation_maximization(eqs, *params,
+                                        replicate_counts=replicate_counts)
+    monkeypatch.setattr(kernels, "JIT", False)
+    expected = expectation_maximization(eqs, *params,
+                                        replicate_counts=replicate_counts)
+
+    for compiled_run, run in zip(compiled, expected):
+        assert list(compiled_run) == list(run)
+        assert list(compiled_run.values()) == \
+            pytest.approx(list(run.values()), abs=1e-9)
+
+
+def test_expectation_maximization_trace():
+    eqs, lengths, allele_idx = simulate(0)
+    params = (lengths, allele_idx, None, PRIOR, 10e-7, 1000, 4, 0.1)
+
+    trace = []
+    traced = expectation_maximization(eqs, *params, trace=trace)
+
+    expected = expectation_maximization(eqs, *params)
+    assert list(traced) == list(expected)
+    assert list(traced.values()) == pytest.approx(list(expected.values()))
+    assert [record["iteration"] for record in trace] == \
+        list(range(1, len(trace) + 1))
+    assert trace[-1]["residual"] < 10e-7
+    assert trace[-1]["alleles"] == len(traced)
+    assert all(a["classes"] >= b["classes"] for a, b in zip(trace, trace[1:]))
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("population", [None, "prior"])
+def test_expectation_maximization_matches_replicates(seed, population):
+    eqs, lengths, allele_idx = simulate(seed)
+    params = (lengths, allele_idx, population, PRIOR, 10e-7, 1000, 4, 0.1)
+
+    counts = np.array([count for _, count in eqs])
+    rng = np.random.default_rng(seed)
+    replicate_counts = rng.multinomial(counts.sum(), counts / counts.sum(),
+                                       size=4).T.astype(float)
+    replicate_counts[:, 0] = counts
+
+    observed = expectation_maximization(eqs, *params,
+                                        replicate_counts=replicate_counts)
+    single = expectation_maximization(eqs, *params,
+                                      replicate_counts=counts[:, None])
+
+    for j in range(replicate_counts.shape[1]):
+        replicate_eqs = [(indices, replicate_counts[i, j])
+                         for i, (indices, _) in enumerate(eqs)]
+        expected = expectation_maximization(replicate_eqs, *params)
+
+        assert list(observed[j]) == list(expected)
+        for allele, abundance in expected.items():
+            assert observed[j][allele] == pytest.approx(abundance, abs=1e-9)
+
+    assert single == [expectation_maximization(eqs, *params)]
+
+
+def test_bootstrap_gene_support():
+    eqs, lengths, allele_idx = simulate(3)
+    allele_eq = defaultdict(set)
+    for i, (indices, _) in enumerate(eqs):
+        for idx in indices:
+            allele_eq[idx].add(i)
+    params = (eqs, allele_eq, lengths, allele_idx, None, PRIOR, 10e-7, 1000,
+              4, 0.1, 0.15)
+
+    _, genotype = genotype_gene("A", sum(count for _, count in eqs), *params)
+    support = bootstrap_gene("A", *params, genotype, 20, 0)
+
+    assert support == bootstrap_gene("A", *params, genotype, 20, 0)
+    assert support["replicates"] == 20
+    assert sum(support["pairs"].values()) == pytest.approx(1.0)
+    assert all(0 < value <= 1 for value in support["alleles"].values())
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_genotype_batch_skips_corrupt_file(tmp_path, threads):
+    eqs, lengths, allele_idx = simulate(0)
+    gene_count = sum(count for _, count in eqs)
+    alignment_info = ["commithash", {"A": eqs}, None, True, [],
+                      {"A": [gene_count, len(eqs), 1.0]}]
+
+    good = str(tmp_path / "good.alignment.p")
+    corrupt = str(tmp_path / "corrupt.alignment.p")
+    truncated = str(tmp_path / "truncated.alignment.p")
+    write_alignment(good, alignment_info)
+    write_alignment(corrupt, alignment_info)
+    _, start = read_header(corrupt, b"ARCASALN")
+    with open(corrupt, "r+b") as handle:
+        handle.seek(start)
+        handle.write(b"\xff" * 8)
+    with open(truncated, "wb") as handle:
+        handle.write(b"\x80\x04\x95")
+
+    results = genotype_batch([corrupt, good, truncated], "commithash",
+                             f"{tmp_path}/", ["A"],
+                             np.array(lengths, dtype=float), allele_idx,
+                             None, PRIOR, 10e-7, 1000, 4, 0.1, 0.15, 1,
+                             threads, False, 0, 0)
+
+    assert [sample for sample, _ in results] == ["corrupt", "good",
+                                                  "truncated"]
+    assert "corrupted" in results[0][1]
+    assert results[1][1] is None
+    assert results[2][1]
+    with open(tmp_path / "good.genotype.json") as file:
+        assert len(json.load(file)["A"]) == 2
+    for sample in ["corrupt", "truncated"]:
+        assert not (tmp_path / f"{sample}.genotype.json").exists()
+        with open(tmp_path / f"{sample}.genotype.log") as file:
+            assert "[genotype] Error:" in file.read()
+
+
+def test_batch_samples_must_be_unique():
+    check_batch_samples(["a/s1.alignment.p", "a/s2.alignment.p"])
+    with pytest.raises(SystemExit, match="b/s1.alignment.p"):
+        check_batch_samples(["a/s1.alignment.p", "b/s1.alignment.p",
+                             "a/s2.alignment.p"])
+
+
+def test_batch_rejects_files(tmp_path):
+    (tmp_path / "batch").mkdir()
+    file = tmp_path / "s1.alignment.p"
+    file.touch()
+
+    output = subprocess.run([sys.executable, f"{ROOT_DIR}/scripts/genotype.py",
+                             str(file), "--batch", str(tmp_path / "batch"),
+                             "-o", str(tmp_path / "out")],
+                            capture_output=True, text=True)
+
+    assert output.returncode != 0
+    assert "--batch does not take" in output.stderr
+
+
+def test_integer_indices_round_trip(tmp_path):
+    eqs, lengths, allele_idx = simulate(1)
+    params = (allele_idx, None, PRIOR, 10e-7, 1000, 4, 0.1)
+    gene_stats = {"A": [sum(count for _, count in eqs), len(eqs), 1.0]}
+
+    # Alignments from before interning are keyed by decimal strings
+    legacy = str(tmp_path / "legacy.alignment.p")
+    with open(legacy, "wb") as handle:
+        pickle.dump(["commithash",
+                     {"A": [([str(idx) for idx in indices], count)
+                            for indices, count in eqs]},
+                     {str(idx): {0} for idx in range(len(lengths))}, True,
+                     [], gene_stats], handle)
+    binary = str(tmp_path / "binary.alignment.p")
+    write_alignment(binary, load_alignment(legacy, "commithash"))
+
+    lengths = np.array(intern_indices({str(idx): length for idx, length
+                                       in enumerate(lengths)}, 0))
+    assert lengths.dtype.kind == "i"
+    assert intern_indices({"0": 5, "2": 7}, 0) == [5, 0, 7]
+
+    expected = expectation_maximization(eqs, lengths, *params)
+    for file in [legacy, binary]:
+        loaded = load_alignment(file, "commithash")[1]["A"]
+
+        assert list(loaded) == eqs
+        assert all(type(idx) is int for indices, _ in loaded
+                   for idx in indices)
+        assert expectation_maximization(loaded, lengths, *params) == expected
+    assert loaded.indices.dtype.kind == "i"
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("jit", [False, True])
+def test_compaction_keeps_abundances(seed, jit, monkeypatch):
+    eqs, lengths, allele_idx = simulate(seed, n_alleles=60, n_eqs=500)
+    # Drops early and hard so classes are merged while alleles remain
+    params = (lengths, allele_idx, None, PRIOR, 10e-7, 1000, 2, 0.3)
+    monkeypatch.setattr(kernels, "JIT", jit)
+
+    # Traced runs stay on the NumPy engine, so the compiled run is checked
+    # to go through the kernel, whose compaction is tested on its own
+    if jit:
+        runs = []
+        squarem = kernels.squarem
+        monkeypatch.setattr(kernels, "squarem",
+                            lambda *args: runs.append(args) or squarem(*args))
+        compacted = expectation_maximization(eqs, *params)
+        assert len(runs) == 1
+    else:
+        trace = []
+        compacted = expectation_maximization(eqs, *params, trace=trace)
+        assert trace[-1]["classes"] < len(eqs)
+    expected = dict_expectation_maximization(eqs, *params)
+
+    assert len(compacted) > 1
+    assert sorted(compacted) == sorted(expected)
+    for allele, abundance in expected.items():
+        assert compacted[allele] == pytest.approx(abundance, abs=1e-9)
+
+
+def test_genotype_genes_order():
+    # Loci with disjoint reference indices, listed out of name order
+    genes = ["C", "A", "D", "B"]
+    eq_idx, gene_stats = dict(), dict()
+    allele_eq = defaultdict(set)
+    lengths, alleles = [], []
+    for seed, gene in enumerate(["C", "A", "B"]):
+        eqs, gene_lengths, gene_idx = simulate(seed, n_alleles=20, n_eqs=150)
+        offset = len(lengths)
+        eq_idx[gene] = [([offset + idx for idx in indices], count)
+                        for indices, count in eqs]
+        for i, (indices, _) in enumerate(eq_idx[gene]):
+            for idx in indices:
+                allele_eq[idx].add(i)
+        gene_stats[gene] = [sum(count for _, count in eqs), len(eqs), 1.0]
+        lengths.extend(gene_lengths)
+        alleles.extend([gene + gene_idx[idx][0][1:]]
+                       for idx in range(len(gene_lengths)))
+
+    def run(threads):
+        with capture_log() as messages:
+            em_results, genotypes = genotype_genes(
+                genes, eq_idx, allele_eq, gene_stats,
+                np.array(lengths, dtype=float), AlleleIndex(alleles), None,
+                PRIOR, 10e-7, 1000, 4, 0.1, 0.15, 1, threads)
+        return em_results, genotypes, messages
+
+    em_results, genotypes, messages = run(3)
+
+    assert (em_results, genotypes, messages) == run(1)
+    assert list(genotypes) == ["C", "A", "B"]
+    assert all(allele.startswith(gene) for gene, genotype in genotypes.items()
+               for allele in genotype)
+
+    # Each locus' messages follow its own heading
+    headings = [i for i, message in enumerate(messages)
+                if message.startswith("[genotype] Genotyping HLA-")]
+    assert [messages[i][-1] for i in headings] == genes
+    for start, end, gene in zip(headings, headings[1:] + [None], genes):
+        block = " ".join(messages[start + 1:end])
+        if gene == "D":
+            assert "Not enough reads aligned to HLA-D" in block
+        else:
+            assert gene + "*" in block
+            assert not any(other + "*" in block
+                           for other in set(genes) - {gene})
@@ -0,0 +1,125 @@
+# Test decoding and compiling reference tables
+import json
+import os
+import sys
+from os.path import dirname, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, f"{ROOT_DIR}/scripts")
+
+import numpy as np
+import pytest
+
+from align import process_counts
+from container import read_header
+from tables import (Reference, load_reference, reference_cache,
+                    reference_magic)
+from test_align import ALLELE_IDX, write_pseudoalignments
+
+
+# Tables are stored as JSON strings inside the reference JSON
+def write_reference(path, commithash="commithash"):
+    allele_idx = {str(i): alleles for i, alleles in enumerate(ALLELE_IDX)}
+    lengths = {"0": 1000, "1": 1001, "2": 1100, "4": 1090}
+    file = str(path / "hla.p.json")
+    with open(file, "w") as handle:
+        json.dump([commithash, [["A", "B"], json.dumps(allele_idx),
+                                json.dumps(lengths),
+                                json.dumps({"A": "3500", "B": "3400"})]],
+                  handle)
+    return file
+
+
+def write_partial_reference(path):
+    allele_idx = {"0": ["A*01:01:01", "A*01:02"], "1": ["A*01:01:01"],
+                  "2": None}
+    partial_exons = {"A*01:02": {"2": [10, 280], "3": [300, 576]}}
+    file = str(path / "hla_partial.p.json")
+    with open(file, "w") as handle:
+        json.dump(["commithash", [["A"], json.dumps(allele_idx),
+                                  json.dumps({"0": "['2']", "1": "['2', '3']"}),
+                                  json.dumps({"0": 270, "1": 546}),
+                                  json.dumps(partial_exons), ["A*01:02"]]],
+                  handle)
+    return file
+
+
+def assert_same_tables(reference, expected):
+    assert list(reference.allele_idx) == list(expected.allele_idx)
+    assert (reference.allele_idx.resolutions ==
+            expected.allele_idx.resolutions)
+    assert reference.lengths.tolist() == expected.lengths.tolist()
+    assert reference.genes == expected.genes
+    assert reference.gene_codes.tolist() == expected.gene_codes.tolist()
+    for name in ["commithash", "partial", "gene_set", "gene_length",
+                 "exon_idx", "partial_exons", "partial_alleles"]:
+        assert getattr(reference, name) == getattr(expected, name)
+
+
+def test_reference_from_json(tmp_path):
+    reference = Reference.from_json(write_reference(tmp_path))
+
+    assert reference.commithash == "commithash"
+    assert not reference.partial
+    assert list(reference.allele_idx) == list(ALLELE_IDX)
+    assert reference.lengths.tolist() == [1000, 1001, 1100, 0, 1090]
+    assert reference.gene_length == {"A": 3500, "B": 3400}
+    assert reference.lengths.dtype == np.int64
+    assert reference.genes == ["A", "B"]
+    assert reference.gene_codes.tolist() == [0, 0, 1, -1, 1]
+
+    eq_idx, _, _ = process_counts(*write_pseudoalignments(tmp_path), None,
+                                  reference.allele_idx, reference.lengths,
+                                  (reference.genes, reference.gene_codes))
+    assert dict(eq_idx) == {"A": [([0], 10.0), ([1], 5.0), ([0, 1], 7.0)],
+                            "B": [([2, 4], 3.0)]}
+
+
+@pytest.mark.parametrize("write", [write_reference, write_partial_reference])
+def test_compiled_reference(tmp_path, write):
+    file = write(tmp_path)
+
+    reference = load_reference(file)
+
+    assert load_reference(file) is reference
+    assert os.path.isfile(reference_cache(file))
+    assert_same_tables(Reference.from_cache(reference_cache(file)),
+                       Reference.from_json(file))
+
+
+def test_stale_reference_cache(tmp_path):
+    file = write_reference(tmp_path)
+    load_reference(file)
+
+    # A rebuilt JSON reference invalidates its cache
+    file = write_reference(tmp_path, "newcommithash")
+    os.utime(file, ns=(0, 0))
+    load_reference.cache_clear()
+
+    assert load_reference(file).commithash == "newcommithash"
+    header, _ = read_header(reference_cache(file), reference_magic)
+    assert header["commithash"] == "newcommithash"
+
+
+def test_corrupted_reference_cache(tmp_path):
+    file = write_reference(tmp_path)
+    cache = reference_cache(file)
+    load_reference(file)
+    load_reference.cache_clear()
+
+    _, start = read_header(cache, reference_magic)
+    with open(cache, "r+b") as handle:
+        handle.seek(start)
+        handle.write(b"\xff")
+
+    assert_same_tables(load_reference(file), Reference.from_json(file))
+    assert_same_tables(Reference.from_cache(cache), Reference.from_json(file))
+
+
+def test_reference_cache_without_json(tmp_path):
+    file = write_reference(tmp_path)
+    expected = load_reference(file)
+    load_reference.cache_clear()
+    os.remove(file)
+
+    assert_same_tables(load_reference(file), expected)